@@ -1,22 +1,27 @@
 """Contains Firebase HTTP auth middleware."""
 import asyncio
 from contextvars import ContextVar
-import datetime
+import os
+import time
 
 import firebase_admin
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from firebase_admin import auth as fauth
+from firebase_admin import _token_gen
 from google import auth as gauth
-from google.cloud.firestore_v1.base_query import FieldFilter
 from google.auth.transport.requests import Request
 from loguru import logger
 
 from moshi.core.base import User, Profile
-from moshi.utils import ctx, storage, GOOGLE_PROJECT
+from moshi.utils import cache, ctx, storage, GOOGLE_PROJECT
 
 DEFAULT_DAILY_CONVO_LIMIT = 500
 logger.info(f"DAILY_CONVO_LIMIT: {DEFAULT_DAILY_CONVO_LIMIT}")
+AUTH_CACHE_SIZE = int(os.getenv("MOSHIAUTHCACHESIZE", 4096))
+logger.info(f"Using auth cache size: {AUTH_CACHE_SIZE} entries")
+USER_RECORD_TTL_SEC = float(os.getenv("MOSHIUSERRECORDTTLSEC", 60))
+logger.info(f"Using user record TTL: {USER_RECORD_TTL_SEC} sec")
 
 gcreds = ContextVar("gcreds")
 
@@ -30,68 +35,140 @@ except ValueError:
     logger.warning("Firebase authentication already initialized.")
 
 security = HTTPBearer()
+# NOTE verify_id_token doesn't check revocation, so a verified token stays valid until it expires.
+id_token_cache = cache.LRUCache("id_tokens", AUTH_CACHE_SIZE, sizeof=lambda _: 1)
+user_claims_cache = cache.LRUCache("user_claims", AUTH_CACHE_SIZE, ttl_sec=USER_RECORD_TTL_SEC, sizeof=lambda _: 1)
 logger.success("Loaded!")
 
-async def exceeded_daily_limit(profile: User) -> bool:
-    """Check if user has exceeded their daily conversation limit by counting the number of conversations they've had today.
-    Conversations are stored in the transcripts collection; their uid attribute must match the users uid.
+async def prefetch_certs():
+    """Fetch Google's token signing certs into the verifier's HTTP cache, so the first request doesn't wait on them.
+    NOTE uses firebase_admin internals, so failures are only logged.
     """
-    col = storage.firestore_client.collection("transcripts")
-    d1ago = datetime.datetime.today() - datetime.timedelta(days=1)
-    ffs = [FieldFilter("uid", "==", profile.uid), FieldFilter("timestamp", ">=", d1ago)]
-    query = col.where(filter=ffs[0]).where(filter=ffs[1]).count()
     try:
-        result = await query.get(timeout = 10)
-    except asyncio.TimeoutError:
-        logger.trace("Timed out while querying Firestore")
-        raise HTTPException(status_code=500, detail="Timed out while querying Firestore")
-    n_convos = result[0][0].value
-    logger.trace(f"User has had {n_convos} conversations in the last 24 hours.")
-    return n_convos >= profile.daily_convo_limit
-    
+        request = fauth._get_client(firebase_admin.get_app())._token_verifier.request
+        await asyncio.to_thread(request, _token_gen.ID_TOKEN_CERT_URI)
+        logger.info("Prefetched ID token signing certs.")
+    except Exception as e:
+        logger.warning(f"Failed to prefetch ID token signing certs: {e}")
+
+
+async def verify_id_token(token: str) -> dict:
+    """Verify the token, caching the result until the token expires.
+    Raises:
+        - fauth.InvalidIdTokenError, fauth.ExpiredIdTokenError
+    """
+    key = cache.digest(token)
+    if (decoded_token := id_token_cache.get(key)) is not None:
+        return decoded_token
+    decoded_token = await asyncio.to_thread(
+        fauth.verify_id_token,
+        token,
+    )
+    if (ttl := decoded_token["exp"] - time.time()) > 0:
+        id_token_cache.put(key, decoded_token, ttl_sec=ttl)
+    return decoded_token
+
+
+async def get_custom_claims(uid: str) -> dict:
+    """Get the user's custom claims from Firebase Auth, cached for USER_RECORD_TTL_SEC."""
+    if (claims := user_claims_cache.get(uid)) is not None:
+        return claims
+    fuser = await asyncio.to_thread(
+        fauth.get_user,
+        uid,
+    )
+    claims = fuser.custom_claims or {}
+    user_claims_cache.put(uid, claims)
+    return claims
 
-async def firebase_auth(
+
+async def verified_token(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-) -> User:
-    """Middleware to check Firebase authentication in headers.
+) -> dict:
+    """Middleware to verify the Firebase ID token in headers.
     Raises:
         - HTTPException 401
     Returns:
-        - User: data from Firebase Auth corresponding to user.
+        - dict: the decoded token.
     """
     token = credentials.credentials
     try:
-        decoded_token = await asyncio.to_thread(
-            fauth.verify_id_token,
-            token,
-        )
+        return await verify_id_token(token)
     except fauth.InvalidIdTokenError:
         logger.trace("Invalid authentication token")
         raise HTTPException(status_code=401, detail="Invalid authentication token")
     except fauth.ExpiredIdTokenError:
         logger.trace("Expired authentication token")
         raise HTTPException(status_code=401, detail="Expired authentication token")
-    fuser = await asyncio.to_thread(
-        fauth.get_user,
-        decoded_token["uid"],
-    )
-    logger.trace(f"User claims: {fuser.custom_claims}")
+
+
+async def daily_convo_count(uid: str) -> int:
+    """Number of conversations the user has started today, from their daily usage counter.
+    The counter is incremented when a conversation starts, see storage.increment_daily_convo_count.
+    Raises:
+        - HTTPException 500 on timeout
+    """
     try:
-        daily_convo_limit = fuser.custom_claims.get("daily_convo_limit", DEFAULT_DAILY_CONVO_LIMIT)
-    except AttributeError:
-        daily_convo_limit = DEFAULT_DAILY_CONVO_LIMIT
+        n_convos = await asyncio.wait_for(storage.get_daily_convo_count(uid), timeout=10)
+    except asyncio.TimeoutError:
+        logger.trace("Timed out while querying Firestore")
+        raise HTTPException(status_code=500, detail="Timed out while querying Firestore")
+    logger.trace(f"User has had {n_convos} conversations today.")
+    return n_convos
+
+
+async def get_user(decoded_token: dict) -> User:
+    """Get the user's claims and check they're within their daily conversation limit, concurrently.
+    Raises:
+        - HTTPException 429, 500
+    """
+    uid = decoded_token["uid"]
+    custom_claims, n_convos = await asyncio.gather(get_custom_claims(uid), daily_convo_count(uid))
+    logger.trace(f"User claims: {custom_claims}")
+    daily_convo_limit = custom_claims.get("daily_convo_limit", DEFAULT_DAILY_CONVO_LIMIT)
     user = User(
-        uid=decoded_token["uid"],
+        uid=uid,
         email=decoded_token["email"],
         daily_convo_limit=daily_convo_limit,
     )
-    limited = await exceeded_daily_limit(user)
-    if limited:
+    if n_convos >= user.daily_convo_limit:
         raise HTTPException(
             status_code=429,
             detail=f"Daily limit of {user.daily_convo_limit} conversations exceeded. Please try again tomorrow.",
         )
+    return user
+
+
+async def get_profile(uid: str) -> Profile:
+    """Raises:
+        - HTTPException 400 if the user has no profile.
+    """
+    try:
+        return await storage.get_profile(uid)
+    except ValueError:
+        logger.trace("User has no profile")
+        raise HTTPException(status_code=400, detail="User has no profile")
+
 
+async def authorize(decoded_token: dict) -> tuple[User, Profile]:
+    """Get the user and their profile concurrently, once the token is verified.
+    Raises:
+        - HTTPException 400, 429, 500
+    """
+    with logger.contextualize(uid=decoded_token["uid"]):
+        user, profile = await asyncio.gather(get_user(decoded_token), get_profile(decoded_token["uid"]))
+        logger.trace("User authorized")
+    return user, profile
+
+
+async def firebase_auth(decoded_token: dict = Depends(verified_token)) -> User:
+    """Middleware to check Firebase authentication in headers.
+    Raises:
+        - HTTPException 401, 429, 500
+    Returns:
+        - User: data from Firebase Auth corresponding to user.
+    """
+    user = await get_user(decoded_token)
     with logger.contextualize(
         uid=decoded_token["uid"],
         email=decoded_token["email"],
@@ -111,11 +188,7 @@ async def user_profile(user: User = Depends(firebase_auth)) -> Profile:
     Returns:
         - Profile: data from Firestore corresponding to user's profile.
     """
-    try:
-        profile = await storage.get_profile(user.uid)
-    except KeyError:
-        logger.trace("User has no profile")
-        raise HTTPException(status_code=400, detail="User has no profile")
+    profile = await get_profile(user.uid)
     with logger.contextualize(
         name=profile.name,
         lang=profile.lang,
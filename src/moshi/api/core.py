@@ -1,3 +1,4 @@
+import asyncio
 from enum import Enum
 from pprint import pprint
 
@@ -6,21 +7,27 @@ from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
 from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import PlainTextResponse, Response
 
 from moshi import __version__ as moshi_version
+from moshi.core import activities
 from moshi.utils.log import setup_loguru
-from moshi.utils import secrets
-from .auth import firebase_auth
+from moshi.utils import metrics, secrets, speech, storage, transcription
+from .auth import firebase_auth, prefetch_certs
 from .routes import offer
 
 setup_loguru()
 app = FastAPI()
+loop_lag_monitor = None
 
 
 async def on_shutdown():
     logger.debug("Shutting down...")
+    if loop_lag_monitor is not None:
+        loop_lag_monitor.cancel()
+    storage.stop_profile_watch()
     await offer.shutdown()
+    transcription.shutdown()
     logger.info("Shut down.")
 
 
@@ -29,8 +36,22 @@ app.add_event_handler("shutdown", on_shutdown)
 
 @logger.catch
 async def on_startup():
+    global loop_lag_monitor
     logger.debug("Starting up...")
     await secrets.login_openai()
+    loop_lag_monitor = asyncio.create_task(metrics.monitor_event_loop_lag(), name="Monitor event loop lag")
+    if storage.PROFILE_WATCH:
+        storage.start_profile_watch()
+    results = await asyncio.gather(
+        speech.voice_catalog.refresh(),
+        transcription.warm(),
+        activities.precompute_translated_prompts(),
+        prefetch_certs(),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Failed to warm cache: {result}")
     logger.info("Started up.")
 
 
@@ -74,6 +95,10 @@ logger.warning(
 def healthz():
     return "OK"
 
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/version")
 def version(user: dict = Depends(firebase_auth)):
     return moshi_version
@@ -8,11 +8,12 @@ from loguru import logger
 from pydantic import BaseModel
 
 from moshi.core.activities import ActivityType
-from moshi.core.base import User
-from moshi.api.auth import user_profile
+from moshi.api.auth import authorize, verified_token
 from moshi.call import WebRTCAdapter
+from moshi.utils import metrics
 
 pcs = set()
+metrics.gauge("moshi_peer_connections", "Open WebRTC peer connections.", lambda: len(pcs))
 
 CONNECTION_TIMEOUT = int(os.getenv("MOSHICONNECTIONTIMEOUT", 5))
 logger.info(f"Using (WebRTC session) CONNECTION_TIMEOUT={CONNECTION_TIMEOUT}")
@@ -37,7 +38,7 @@ class Offer(BaseModel):
 async def new_call(
     offer: Offer,
     activity_type: ActivityType,
-    profile: User = Depends(user_profile),
+    decoded_token: dict = Depends(verified_token),
 ):
     """In WebRTC, there's an initial offer->answer exchange that negotiates the connection parameters.
     This endpoint accepts an offer request from a client and returns an answer with the SDP (session description protocol).
@@ -45,8 +46,12 @@ async def new_call(
     Sources:
         - RFC 3264
         - RFC 2327
+    Authorization (claims, daily limit, and profile) runs concurrently with answer generation; if it fails, the
+    connection is closed before an answer is returned.
     """
-    adapter = WebRTCAdapter(activity_type=activity_type)
+    authorization = asyncio.create_task(authorize(decoded_token), name="Authorize call")
+    # NOTE the connection can reach "connecting", and start the adapter, before the answer is returned.
+    adapter = WebRTCAdapter(activity_type=activity_type, authorization=authorization)
     desc = RTCSessionDescription(**offer.model_dump())
     pc = RTCPeerConnection()
     pcs.add(pc)
@@ -108,9 +113,16 @@ async def new_call(
             await adapter.stop()
             logger.debug(f"Adapter stopped.")
 
-    await pc.setRemoteDescription(desc)
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
-    logger.trace(f"answer: {answer}")
+    try:
+        await pc.setRemoteDescription(desc)
+        answer = await pc.createAnswer()
+        await pc.setLocalDescription(answer)
+        logger.trace(f"answer: {answer}")
+        await authorization
+    except BaseException:
+        authorization.cancel()
+        await pc.close()
+        pcs.discard(pc)
+        raise
 
     return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
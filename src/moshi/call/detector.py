@@ -2,6 +2,8 @@
 tracks.
 """
 import asyncio
+import collections
+import os
 import time
 from typing import Callable
 
@@ -18,6 +20,27 @@ UTT_START_TIMEOUT_SEC = (
 # TODO tune the UTT_END_TIMEOUT_SEC param for typical network conditions.
 UTT_END_TIMEOUT_SEC = 0.08  # when there's a gap of this length between frames, consider the utterance ended.
 UTT_MAX_LEN_SEC = 25.0  # maximum length of an utterance.
+UTT_DETECTOR_MODES = {"vad", "ring", "gap"}
+UTT_DETECTOR_MODE = os.getenv("MOSHIDETECTORMODE", "vad")  # "vad" or "ring" for energy-based endpointing, "gap" for frame gaps.
+assert UTT_DETECTOR_MODE in UTT_DETECTOR_MODES, f"Unsupported detector mode: {UTT_DETECTOR_MODE}"
+logger.info(f"Using utterance detector mode: {UTT_DETECTOR_MODE}")
+VAD_SPEECH_RATIO = float(os.getenv("MOSHIVADSPEECHRATIO", 3.0))  # energy this many times the noise floor is speech.
+VAD_SILENCE_RATIO = float(os.getenv("MOSHIVADSILENCERATIO", 1.8))  # energy under this many times the noise floor is silence.
+VAD_HANGOVER_SEC = float(os.getenv("MOSHIVADHANGOVERSEC", 0.6))  # this much continuous silence ends the utterance.
+VAD_ONSET_SEC = 0.06  # this much continuous speech starts the utterance.
+VAD_PREROLL_SEC = 0.3  # keep this much audio from before the onset so the first syllable isn't clipped.
+VAD_NOISE_ADAPT = 0.05  # smoothing factor for raising the noise floor; it falls immediately to quieter frames.
+VAD_MAX_SPEECH_ZCR = float(os.getenv("MOSHIVADMAXSPEECHZCR", 0.5))  # in ring mode, noisier windows can't count as speech.
+VAD_BATCH_WINDOWS = 4  # in ring mode, analyze this many frames at a time; adds at most this many frames of delay.
+VAD_STALL_TIMEOUT_SEC = 1.0  # in vad mode, a gap of this length between frames (e.g. network dropout) ends the utterance.
+BARGE_IN_ONSET_SEC = float(os.getenv("MOSHIBARGEINONSETSEC", 0.12))  # this much continuous speech interrupts playback.
+SEGMENT_PAUSE_SEC = float(os.getenv("MOSHISEGMENTPAUSESEC", 0.3))  # in vad mode, a pause this long cuts a segment...
+SEGMENT_MIN_SEC = float(os.getenv("MOSHISEGMENTMINSEC", 3.0))  # ...if the segment is at least this long.
+assert SEGMENT_PAUSE_SEC < VAD_HANGOVER_SEC, "segments must be cut before the utterance ends"
+assert VAD_SPEECH_RATIO >= VAD_SILENCE_RATIO >= 1.0
+logger.info(
+    f"Using VAD speech ratio: {VAD_SPEECH_RATIO}, silence ratio: {VAD_SILENCE_RATIO}, hangover: {VAD_HANGOVER_SEC} sec"
+)
 
 logger.success("Loaded!")
 
@@ -30,13 +53,91 @@ class UtteranceNotStartedError(Exception):
     ...
 
 
+class EnergyVAD:
+    """Voice activity detection from frame RMS energy.
+    The noise floor tracks the background level: it drops immediately to quieter frames and rises slowly while the user
+    isn't speaking. Frames between the silence and speech thresholds hold the current state (hysteresis); speech must
+    last VAD_ONSET_SEC to start an utterance and silence must last the hangover time to end it.
+    """
+
+    def __init__(
+        self,
+        speech_ratio: float = VAD_SPEECH_RATIO,
+        silence_ratio: float = VAD_SILENCE_RATIO,
+        hangover_sec: float = VAD_HANGOVER_SEC,
+        onset_sec: float = VAD_ONSET_SEC,
+        max_speech_zcr: float = VAD_MAX_SPEECH_ZCR,
+        noise_adapt: float = VAD_NOISE_ADAPT,
+        min_noise_floor: float = audio.MIN_NOISE_FLOOR,
+    ):
+        if not speech_ratio >= silence_ratio >= 1.0:
+            raise ValueError(
+                f"Require speech_ratio >= silence_ratio >= 1.0, got: {speech_ratio}, {silence_ratio}"
+            )
+        self.speech_ratio = speech_ratio
+        self.silence_ratio = silence_ratio
+        self.hangover_sec = hangover_sec
+        self.onset_sec = onset_sec
+        self.max_speech_zcr = max_speech_zcr
+        self.noise_adapt = noise_adapt
+        self.min_noise_floor = min_noise_floor
+        self.noise_floor = None
+        self.reset()
+
+    def reset(self):
+        """Reset the speech state. The noise floor persists across utterances."""
+        self.speaking = False
+        self.__speech_sec = 0.0
+        self.__silence_sec = 0.0
+
+    @property
+    def silence_sec(self) -> float:
+        """Length of the current run of silence."""
+        return self.__silence_sec
+
+    def update(self, energy: float, seconds: float, zcr: float = 0.0) -> bool:
+        """Feed the RMS energy (and optionally the zero-crossing rate) of a frame of the given length.
+        Returns whether the user is speaking.
+        """
+        if self.noise_floor is None:
+            self.noise_floor = max(energy, self.min_noise_floor)
+        if energy >= self.speech_ratio * self.noise_floor and zcr <= self.max_speech_zcr:
+            self.__speech_sec += seconds
+            self.__silence_sec = 0.0
+        elif energy <= self.silence_ratio * self.noise_floor:
+            self.__silence_sec += seconds
+            self.__speech_sec = 0.0
+        if energy < self.noise_floor:
+            self.noise_floor = max(energy, self.min_noise_floor)
+        elif not self.speaking and self.__speech_sec == 0.0:
+            # NOTE only non-speech frames adapt the floor, so a pending onset can't raise it out of reach.
+            self.noise_floor += self.noise_adapt * (energy - self.noise_floor)
+        # NOTE the 1e-9 absorbs rounding in the summed frame lengths, e.g. ten 0.02 sec frames sum to < 0.2 sec.
+        if not self.speaking and self.__speech_sec >= self.onset_sec - 1e-9:
+            self.speaking = True
+        elif self.speaking and self.__silence_sec >= self.hangover_sec - 1e-9:
+            self.speaking = False
+        return self.speaking
+
+
 class UtteranceDetector:
     """An audio media sink that detects utterances."""
 
-    def __init__(self):
+    def __init__(self, mode: str = UTT_DETECTOR_MODE):
+        if mode not in UTT_DETECTOR_MODES:
+            raise ValueError(f"Unsupported detector mode: {mode}")
+        self.__mode = mode
         self.__fifo = AudioFifo()
+        self.__ring = None
         self.__track = None
-        logger.debug("Initialized")
+        self.__vad = EnergyVAD()
+        self.__onset_preroll = None  # audio up to a speech onset detected by wait_speech_onset()
+        self.endpoint_delay = None  # how long the last utterance had ended before the detector noticed, in seconds.
+        logger.debug(f"Initialized in {mode} mode")
+
+    @property
+    def mode(self) -> str:
+        return self.__mode
 
     def setTrack(self, track: MediaStreamTrack):
         """Set the audio track to listen to."""
@@ -53,12 +154,25 @@ class UtteranceDetector:
         self.__track = track
         logger.debug("Track set")
 
-    async def get_utterance(self) -> AudioFrame:
-        """Raises:
+    async def get_utterance(self, on_segment: Callable[[AudioFrame], None] | None = None) -> AudioFrame:
+        """Args:
+        - on_segment: in vad mode, called with each segment of the utterance as it ends at a pause of
+            SEGMENT_PAUSE_SEC, while the user is still speaking, e.g. to start transcribing it. If any segment was cut,
+            it's also called with the rest of the utterance before returning, so the segments cover the whole utterance.
+        Raises:
         - aiortc.MediaStreamError if user hangs up.
         - UtteranceNotStartedError if the user doesn't start speaking within: UTT_START_TIMEOUT_SEC.
         - UtteranceTooLongError if the utterance is longer than the maximum allowed length: UTT_MAX_LEN_SEC.
         """
+        self.__fifo = AudioFifo()
+        if self.__mode == "vad":
+            return await self.__get_utterance_vad(on_segment)
+        if self.__mode == "ring":
+            return await self.__get_utterance_ring()
+        return await self.__get_utterance_gap()
+
+    async def __get_utterance_gap(self) -> AudioFrame:
+        """Endpoint the utterance on a gap between frames."""
         logger.trace("Waiting for utterance to start...")
         try:
             first_frame = await asyncio.wait_for(
@@ -80,6 +194,7 @@ class UtteranceDetector:
                 )
             except asyncio.TimeoutError as e:
                 logger.trace("Utterance ended")
+                self.endpoint_delay = UTT_END_TIMEOUT_SEC
                 break
             self.__fifo.write(frame)
             utt_sec += audio.get_frame_seconds(frame)
@@ -89,3 +204,165 @@ class UtteranceDetector:
                 )
         logger.debug(f"Detected utterance that is {utt_sec:.3f} sec long")
         return self.__fifo.read()
+
+    async def __wait_vad_onset(self) -> collections.deque[AudioFrame]:
+        """Receive frames until the EnergyVAD detects speech. Returns the frames from VAD_PREROLL_SEC before the onset."""
+        self.__vad.reset()
+        preroll = collections.deque()
+        preroll_sec = 0.0
+        while not self.__vad.speaking:
+            frame = await self.__track.recv()
+            frame_sec = audio.get_frame_seconds(frame)
+            self.__vad.update(audio.get_frame_energy(frame), frame_sec)
+            preroll.append(frame)
+            preroll_sec += frame_sec
+            while preroll_sec - audio.get_frame_seconds(preroll[0]) >= VAD_PREROLL_SEC:
+                preroll_sec -= audio.get_frame_seconds(preroll.popleft())
+        return preroll
+
+    async def wait_speech_onset(self):
+        """Listen until the user starts speaking, e.g. over the assistant's reply; the next get_utterance() continues
+        from the onset. Speech must last BARGE_IN_ONSET_SEC, longer than a normal onset, so noise and echo of the
+        reply are less likely to count. Cancel it to stop listening.
+        Raises:
+            - aiortc.MediaStreamError if user hangs up.
+            - ValueError if the detector isn't in vad mode.
+        """
+        if self.__mode != "vad":
+            raise ValueError(f"Speech onset detection requires vad mode, not {self.__mode} mode")
+        onset_sec = self.__vad.onset_sec
+        self.__vad.onset_sec = BARGE_IN_ONSET_SEC
+        try:
+            self.__onset_preroll = await self.__wait_vad_onset()
+        finally:
+            self.__vad.onset_sec = onset_sec
+        logger.trace(f"Speech onset, noise floor: {self.__vad.noise_floor:.3f}")
+
+    async def __get_utterance_vad(self, on_segment: Callable[[AudioFrame], None] | None = None) -> AudioFrame:
+        """Endpoint the utterance on the energy of the audio using the EnergyVAD."""
+        if self.__onset_preroll is not None:
+            logger.trace("Continuing utterance from detected speech onset...")
+            preroll, self.__onset_preroll = self.__onset_preroll, None
+        else:
+            logger.trace("Waiting for utterance to start...")
+            try:
+                async with asyncio.timeout(UTT_START_TIMEOUT_SEC):
+                    preroll = await self.__wait_vad_onset()
+            except TimeoutError as e:
+                raise UtteranceNotStartedError(
+                    f"Utterance not started within {UTT_START_TIMEOUT_SEC} sec"
+                ) from e
+        logger.trace(f"Utterance started, noise floor: {self.__vad.noise_floor:.3f}")
+        utt_sec = 0.0
+        stalled_sec = 0.0
+        segments = []
+        for frame in preroll:
+            frame.pts = None  # NOTE the fifo rejects discontinuous pts e.g. from packet loss.
+            self.__fifo.write(frame)
+            utt_sec += audio.get_frame_seconds(frame)
+        seg_sec = utt_sec
+        while self.__vad.speaking:
+            try:
+                frame = await asyncio.wait_for(
+                    self.__track.recv(),
+                    timeout=VAD_STALL_TIMEOUT_SEC,
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Track stalled for {VAD_STALL_TIMEOUT_SEC} sec, ending utterance")
+                stalled_sec = VAD_STALL_TIMEOUT_SEC
+                break
+            frame_sec = audio.get_frame_seconds(frame)
+            self.__vad.update(audio.get_frame_energy(frame), frame_sec)
+            frame.pts = None
+            self.__fifo.write(frame)
+            utt_sec += frame_sec
+            seg_sec += frame_sec
+            if utt_sec > UTT_MAX_LEN_SEC:
+                raise UtteranceTooLongError(
+                    f"Utterance too long: {utt_sec:.3f} sec > {UTT_MAX_LEN_SEC} sec"
+                )
+            if (
+                on_segment is not None
+                and self.__vad.speaking
+                and self.__vad.silence_sec >= SEGMENT_PAUSE_SEC
+                and seg_sec >= SEGMENT_MIN_SEC
+            ):
+                logger.trace(f"Cut segment that is {seg_sec:.3f} sec long")
+                segments.append(self.__fifo.read())
+                on_segment(segments[-1])
+                seg_sec = 0.0
+        self.endpoint_delay = self.__vad.silence_sec + stalled_sec
+        logger.debug(f"Detected utterance that is {utt_sec:.3f} sec long")
+        if segments:
+            if (rest := self.__fifo.read()) is not None:
+                segments.append(rest)
+                on_segment(rest)
+            for segment in segments:
+                segment.pts = None
+                self.__fifo.write(segment)
+        return self.__fifo.read()
+
+    async def __recv_to_ring(self) -> audio.PCMRingBuffer:
+        """Receive frames into the ring buffer until a batch is ready for analysis.
+        The ring is created to match the first frame, and grows as the call goes on.
+        """
+        while self.__ring is None or self.__ring.pending < VAD_BATCH_WINDOWS:
+            frame = await self.__track.recv()
+            if self.__ring is None:
+                self.__ring = audio.PCMRingBuffer(
+                    capacity_sec=UTT_MAX_LEN_SEC + VAD_PREROLL_SEC + 1.0,
+                    window=frame.samples,
+                    channels=len(frame.layout.channels),
+                    rate=frame.rate,
+                    max_batch=VAD_BATCH_WINDOWS,
+                )
+                logger.debug(f"Created ring buffer of up to {self.__ring.capacity} samples")
+            self.__ring.write(frame)
+        return self.__ring
+
+    async def __get_utterance_ring(self) -> AudioFrame:
+        """Endpoint the utterance like vad mode, but buffer the audio in a preallocated ring and compute the frame
+        statistics in batches without per-frame allocation.
+        """
+        self.__vad.reset()
+        logger.trace("Waiting for utterance to start...")
+        try:
+            async with asyncio.timeout(UTT_START_TIMEOUT_SEC):
+                while not self.__vad.speaking:
+                    ring = await self.__recv_to_ring()
+                    rms, zcr = ring.analyze()
+                    for i in range(len(rms)):
+                        if self.__vad.update(rms[i], ring.window_sec, zcr[i]):
+                            onset = ring.analyzed - (len(rms) - i - 1) * ring.window
+                            break
+        except TimeoutError as e:
+            raise UtteranceNotStartedError(
+                f"Utterance not started within {UTT_START_TIMEOUT_SEC} sec"
+            ) from e
+        logger.trace(f"Utterance started, noise floor: {self.__vad.noise_floor:.3f}")
+        start = max(ring.oldest, onset - int(VAD_PREROLL_SEC * ring.rate))
+        end = ring.analyzed
+        stalled_sec = 0.0
+        max_samples = int(UTT_MAX_LEN_SEC * ring.rate)
+        while self.__vad.speaking:
+            try:
+                ring = await asyncio.wait_for(
+                    self.__recv_to_ring(),
+                    timeout=VAD_STALL_TIMEOUT_SEC,
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Track stalled for {VAD_STALL_TIMEOUT_SEC} sec, ending utterance")
+                stalled_sec = VAD_STALL_TIMEOUT_SEC
+                break
+            rms, zcr = ring.analyze()
+            for i in range(len(rms)):
+                end += ring.window
+                if not self.__vad.update(rms[i], ring.window_sec, zcr[i]):
+                    break
+            if end - start > max_samples:
+                raise UtteranceTooLongError(
+                    f"Utterance too long: {(end - start) / ring.rate:.3f} sec > {UTT_MAX_LEN_SEC} sec"
+                )
+        self.endpoint_delay = self.__vad.silence_sec + stalled_sec + (ring.written - end) / ring.rate
+        logger.debug(f"Detected utterance that is {(end - start) / ring.rate:.3f} sec long")
+        return ring.read(start, end)
@@ -2,9 +2,11 @@
 import asyncio
 import os
 import time
-from typing import Callable
+from typing import AsyncIterable, Callable
 
+import numpy as np
 from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
 from av import AudioFifo, AudioFrame
 from loguru import logger
 
@@ -17,52 +19,163 @@ FRAME_SEND_TIMEOUT_SEC = 0.5  # how long beyond the length of the response to wa
 FRAME_SIZE = 960
 assert FRAME_SIZE >= 128 and FRAME_SIZE <= 4096
 logger.info(f"Using transport frame size: {FRAME_SIZE}")
+SILENCE_TAIL_SEC = float(os.getenv("MOSHISILENCETAILSEC", 0.2))  # silence to send after each reply before going idle.
+logger.info(f"Using silence tail: {SILENCE_TAIL_SEC} sec")
+RESPONDER_BACKEND = os.getenv("MOSHIRESPONDERBACKEND", "buffer")  # buffer or fifo
+assert RESPONDER_BACKEND in {"buffer", "fifo"}, f"Unsupported responder backend: {RESPONDER_BACKEND}"
+logger.info(f"Using responder backend: {RESPONDER_BACKEND}")
+FRAME_POOL_SIZE = 3  # NOTE the sender encodes one frame while the next is read, so at least 2.
 
 logger.debug("Loaded responder module.")
 
 
+class FifoBackend:
+    """Queues reply audio in a PyAV AudioFifo; each read allocates a new frame."""
+
+    def __init__(self):
+        self.__fifo = AudioFifo()
+
+    def write(self, frame: AudioFrame):
+        frame.pts = None
+        self.__fifo.write(frame)
+
+    def read(self, samples: int, pad: bool = False) -> AudioFrame | None:
+        if pad and 0 < self.__fifo.samples < samples:
+            silence = audio.empty_frame(
+                samples - self.__fifo.samples,
+                format=self.__fifo.format.name,
+                layout=self.__fifo.layout.name,
+                rate=self.__fifo.sample_rate,
+            )
+            self.__fifo.write(silence)
+        return self.__fifo.read(samples)
+
+    def clear(self):
+        self.__fifo.read()
+
+
+class BufferBackend:
+    """Queues reply audio as interleaved PCM in one contiguous buffer, and reads it into a small pool of reused frames.
+    Only handles frames in the pipeline format. A frame returned by read() is overwritten FRAME_POOL_SIZE reads later.
+    """
+
+    def __init__(self, samples: int = FRAME_SIZE, pool_size: int = FRAME_POOL_SIZE):
+        self.__pool = [audio.empty_frame(samples) for _ in range(pool_size)]
+        self.__pool_pcm = [audio.frame_pcm(frame) for frame in self.__pool]
+        self.__channels = len(self.__pool[0].layout.channels)
+        self.__pcm = np.empty(SAMPLE_RATE * self.__channels, dtype=np.int16)
+        self.__start = 0  # NOTE indices into __pcm, in interleaved samples.
+        self.__end = 0
+        self.__next = 0
+
+    def write(self, frame: AudioFrame):
+        assert len(frame.layout.channels) == self.__channels, f"Expected {self.__channels} channels: {frame}"
+        pcm = audio.frame_pcm(frame)
+        if self.__end + len(pcm) > len(self.__pcm):
+            pending = self.__end - self.__start
+            if pending + len(pcm) > len(self.__pcm):
+                grown = np.empty(max(2 * len(self.__pcm), pending + len(pcm)), dtype=np.int16)
+                grown[:pending] = self.__pcm[self.__start : self.__end]
+                self.__pcm = grown
+            else:
+                self.__pcm[:pending] = self.__pcm[self.__start : self.__end]
+            self.__start, self.__end = 0, pending
+        self.__pcm[self.__end : self.__end + len(pcm)] = pcm
+        self.__end += len(pcm)
+
+    def read(self, samples: int, pad: bool = False) -> AudioFrame | None:
+        n = samples * self.__channels
+        pending = self.__end - self.__start
+        if pending == 0 or (pending < n and not pad):
+            return None
+        i = self.__next
+        assert self.__pool[i].samples == samples, "Reads must be of the pooled frame size"
+        m = min(n, pending)
+        self.__pool_pcm[i][:m] = self.__pcm[self.__start : self.__start + m]
+        self.__pool_pcm[i][m:] = 0
+        self.__start += m
+        self.__next = (i + 1) % len(self.__pool)
+        return self.__pool[i]
+
+    def clear(self):
+        self.__start = self.__end = 0
+
+
 class ResponsePlayerStream(MediaStreamTrack):
+    """Plays audio written to it on a media clock, FRAME_SIZE samples per frame.
+    Frames are released no more than BUFFER_AHEAD_SEC ahead of the clock. After each reply, and when the track starts,
+    SILENCE_TAIL_SEC of silence is sent; then recv() blocks until more audio is written and the clock restarts.
+    """
+
     kind = "audio"
 
-    def __init__(self):
+    def __init__(self, backend: str = RESPONDER_BACKEND):
         super().__init__()
-        self.__fifo = AudioFifo()
+        self.__fifo = BufferBackend() if backend == "buffer" else FifoBackend()
         self.__sent = asyncio.Event()
-        self.__send_start_time = None
-        self.__sent_buffer_time = None
+        self.__sent.set()
+        self.__data = asyncio.Event()
+        self.__silence = audio.empty_frame(FRAME_SIZE)  # NOTE reused, only its pts changes.
+        self.__silence_frames = self.__silence_tail_frames = round(SILENCE_TAIL_SEC * SAMPLE_RATE / FRAME_SIZE)
+        self.__clock_start = None  # monotonic time of the clock's sample 0
+        self.__clock_samples = 0  # samples released since the clock started
+        self.__pts = 0
+        self.played_samples = 0  # samples of written audio released to the client, not counting silence or flushes.
 
     async def recv(self) -> AudioFrame:
-        """Return audio from the fifo whenever it exists.
-        Otherwise, wait for audio to be written to the fifo.
-        """
-        frame = None
-        while frame == None:
-            frame = self.__fifo.read(FRAME_SIZE)
-            if not frame:
-                # NOTE must flush partial frames;
-                #   these will otherwise cause big noise spikes at end of utterance.
-                self.__fifo.read()
-                self.__sent.set()
-                await asyncio.sleep(0.05)
-            else:  # NOTE must buffer or there will be SILENT buffer overflow on the client.
-                frame_sec = audio.get_frame_seconds(frame)
-                wall_elapsed_time = time.monotonic() - self.__send_start_time
-                if self.__sent_buffer_time - wall_elapsed_time > BUFFER_AHEAD_SEC:
-                    throttle_sec = BUFFER_AHEAD_SEC / 3.0
-                    await asyncio.sleep(throttle_sec)
-                    # logger.trace(f"playback throttled {throttle_sec} sec")
-                self.__sent_buffer_time += frame_sec
-                # logger.trace(f"frame.pts: {frame.pts}")
+        """Return the next frame of audio, or of silence just after a reply; otherwise wait for audio to be written."""
+        while (frame := self.__fifo.read(FRAME_SIZE, pad=True)) is None:
+            # NOTE a partial frame at the end of the written audio is padded with silence and played, not left to
+            #   prefix the next write, which causes big noise spikes; only flush() drops it.
+            self.__sent.set()
+            if self.__silence_frames > 0:
+                self.__silence_frames -= 1
+                frame = self.__silence
+                break
+            if self.readyState != "live":
+                raise MediaStreamError
+            self.__data.clear()
+            await self.__data.wait()
+            self.__clock_start = None
+        # NOTE must pace or there will be SILENT buffer overflow on the client.
+        now = time.monotonic()
+        if self.__clock_start is None:
+            self.__clock_start, self.__clock_samples = now, 0
+        if (wait := self.__clock_start + self.__clock_samples / SAMPLE_RATE - BUFFER_AHEAD_SEC - now) > 0:
+            await asyncio.sleep(wait)
+        self.__clock_samples += frame.samples
+        if frame is not self.__silence:
+            self.played_samples += frame.samples
+        frame.pts = self.__pts
+        self.__pts += frame.samples
         return frame
 
-    async def send_audio(self, frame: AudioFrame):
-        self.__send_start_time = time.monotonic()
-        self.__sent_buffer_time = 0.0
-        frame.pts = self.__fifo.samples_written
+    def write_audio(self, frame: AudioFrame):
+        """Append audio to the fifo without waiting for it to play."""
         self.__fifo.write(frame)
+        self.__silence_frames = self.__silence_tail_frames
         self.__sent.clear()
+        self.__data.set()
+
+    def flush(self):
+        """Drop the audio not yet played, e.g. when the user interrupts; the silence tail still plays.
+        NOTE up to BUFFER_AHEAD_SEC already released to the client still plays out there.
+        """
+        self.__fifo.clear()
+        self.__sent.set()
+
+    def stop(self):
+        super().stop()
+        self.__data.set()  # NOTE wake recv() so it raises MediaStreamError
+
+    async def wait_sent(self):
+        """Wait for the fifo to be played out."""
         await self.__sent.wait()
 
+    async def send_audio(self, frame: AudioFrame):
+        self.write_audio(frame)
+        await self.wait_sent()
+
 
 class ResponsePlayer:
     """When audio is set, it is sent over the track."""
@@ -74,6 +187,14 @@ class ResponsePlayer:
     def audio(self):
         return self.__track
 
+    @property
+    def played_samples(self) -> int:
+        return self.__track.played_samples
+
+    def flush(self):
+        """Stop playing the current utterance."""
+        self.__track.flush()
+
     async def send_utterance(self, frame: AudioFrame):
         """Write the frame to the audio track, thereby sending it to the remote client.
         Raises:
@@ -90,3 +211,26 @@ class ResponsePlayer:
             timeout=timeout,
         )
         logger.trace(f"Utterance sent.")
+
+    async def send_utterance_stream(self, frames: AsyncIterable[AudioFrame]):
+        """Write frames to the audio track as they arrive, then wait for all of them to be sent.
+        Raises:
+            - aiortc.MediaStreamError if the remote client hangs up.
+            - asyncio.TimeoutError if the audio track is busy for longer than: FRAME_SEND_TIMEOUT_SEC beyond the length
+                of the audio.
+        """
+        utt_sec = 0.0
+        async for frame in frames:
+            assert frame.rate == SAMPLE_RATE
+            frame_sec = audio.get_frame_seconds(frame)
+            logger.trace(f"Sending utterance chunk of length: {frame_sec:.3f} sec")
+            self.__track.write_audio(frame)
+            utt_sec += frame_sec
+        if utt_sec == 0.0:
+            logger.warning("No audio to send.")
+            return
+        await asyncio.wait_for(
+            self.__track.wait_sent(),
+            timeout=utt_sec + FRAME_SEND_TIMEOUT_SEC,
+        )
+        logger.trace(f"Utterance of length {utt_sec:.3f} sec sent.")
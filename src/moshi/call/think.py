@@ -1,16 +1,17 @@
 """ This module abstracts specific chatbot implementations for use in the ChitChat app. """
+import contextlib
 import os
 import re
 from dataclasses import asdict
 from enum import Enum
 from pprint import pformat
-from typing import NewType
+from typing import AsyncIterator, NewType
 
 import openai
 from loguru import logger
 
 from moshi import Message, Model, ModelType, Role
-from moshi.utils import secrets
+from moshi.utils import lang, metrics, secrets
 
 OPENAI_COMPLETION_MODEL = Model(
     os.getenv("OPENAI_COMPLETION_MODEL", "text-davinci-002")
@@ -34,11 +35,11 @@ def _get_type_of_model(model: Model) -> ModelType:
 def _clean_completion(msg: str) -> str:
     """Remove all the formatting the completion model thinks it should give."""
     logger.trace("Cleaning response...")
-    # 1. only keep first response, remove its prefix
-    pattern = r"(?:\n|^)([0-9]+:)(?:[ \n\t]*)([^\n\t]+)"
-    match = re.search(pattern, msg)
+    # 1. only keep first response, remove its role prefix e.g. "2:" or "assistant:"
+    pattern = r"\s*(?:\w+:(?=\s))?[ \n\t]*([^\n\t]+)"
+    match = re.match(pattern, msg)
     if match:
-        first_response = match.group(2)
+        first_response = match.group(1)
         logger.trace(f"Regex matched: {first_response}")
         result = first_response
     else:
@@ -47,6 +48,26 @@ def _clean_completion(msg: str) -> str:
     return result
 
 
+ROLE_PREFIX = re.compile(r"^[0-9]+:\s*")
+MAYBE_ROLE_PREFIX = re.compile(r"[0-9]+:?\s*")  # NOTE the start of a stream that may yet turn out to be a prefix.
+
+
+async def _strip_role_prefix(tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Drop the leading whitespace and role prefix, e.g. "2: ", that a completion model may start its response with.
+    Only the start of the stream is cleaned; the rest passes through untouched.
+    """
+    head = ""
+    async with contextlib.aclosing(tokens):
+        async for token in tokens:
+            head = (head + token).lstrip()
+            if head and not MAYBE_ROLE_PREFIX.fullmatch(head):
+                break
+        if text := ROLE_PREFIX.sub("", head, count=1):
+            yield text
+        async for token in tokens:
+            yield token
+
+
 ChatCompletionPayload = NewType("ChatCompletionPayload", list[dict[str, str]])
 CompletionPayload = NewType("CompletionPayload", str)
 
@@ -95,13 +116,14 @@ async def _chat_completion(
     """Get the message"""
     msg_contents = []
     assert _get_type_of_model(model) == ModelType.CHAT
-    response = await openai.ChatCompletion.acreate(
-        model=model,
-        messages=payload,
-        n=n,
-        user=user,
-        **kwargs,
-    )
+    with metrics.track_api("openai_chat_completion"):
+        response = await openai.ChatCompletion.acreate(
+            model=model,
+            messages=payload,
+            n=n,
+            user=user,
+            **kwargs,
+        )
     logger.debug(f"response:\n{pformat(response)}")
     for choice in response.choices:
         if reason := choice["finish_reason"] != "stop":
@@ -118,13 +140,14 @@ async def _completion(
 ) -> list[str]:
     assert _get_type_of_model(model) == ModelType.COMP
     msg_contents = []
-    response = await openai.Completion.acreate(
-        model=model,
-        prompt=payload,
-        n=n,
-        user=user,
-        **kwargs,
-    )
+    with metrics.track_api("openai_completion"):
+        response = await openai.Completion.acreate(
+            model=model,
+            prompt=payload,
+            n=n,
+            user=user,
+            **kwargs,
+        )
     logger.debug(f"response:\n{pformat(response)}")
     for choice in response.choices:
         if reason := choice["finish_reason"] != "stop":
@@ -168,3 +191,77 @@ async def completion_from_assistant(
     assert isinstance(msg_contents, list)
     assert all(isinstance(mc, str) for mc in msg_contents)
     return msg_contents
+
+
+async def _stream_chat_completion(
+    payload: ChatCompletionPayload, model: Model, user: str | None = None, **kwargs
+) -> AsyncIterator[str]:
+    assert _get_type_of_model(model) == ModelType.CHAT
+    with metrics.track_api("openai_chat_completion"):
+        response = await openai.ChatCompletion.acreate(
+            model=model,
+            messages=payload,
+            n=1,
+            user=user,
+            stream=True,
+            **kwargs,
+        )
+    async with contextlib.aclosing(response):
+        async for chunk in response:
+            choice = chunk.choices[0]
+            if (reason := choice.get("finish_reason")) not in {None, "stop"}:
+                logger.warning(f"Got finish_reason: {reason}")
+            if content := choice.delta.get("content"):
+                yield content
+
+
+async def _stream_completion(
+    payload: CompletionPayload, model: Model, user: str | None = None, **kwargs
+) -> AsyncIterator[str]:
+    assert _get_type_of_model(model) == ModelType.COMP
+    with metrics.track_api("openai_completion"):
+        response = await openai.Completion.acreate(
+            model=model,
+            prompt=payload,
+            n=1,
+            user=user,
+            stream=True,
+            **kwargs,
+        )
+    async with contextlib.aclosing(response):
+        async for chunk in response:
+            choice = chunk.choices[0]
+            if (reason := choice.get("finish_reason")) not in {None, "stop"}:
+                logger.warning(f"Got finish_reason: {reason}")
+            if text := choice.text:
+                yield text
+
+
+async def stream_completion_from_assistant(
+    messages: list[Message],
+    model=Model.TEXTDAVINCI002,
+    user: str | None = None,
+    **kwargs,
+) -> AsyncIterator[str]:
+    """Stream the conversational response from the LLM a sentence at a time, as soon as each sentence is complete.
+    Sentences keep their trailing whitespace, so joining them reproduces the response.
+    Args:
+        kwargs: passed directly to the OpenAI
+    """
+    await secrets.login_openai()
+    if _get_type_of_model(model) == ModelType.CHAT:
+        payload = _chat_completion_payload_from_messages(messages)
+        tokens = _stream_chat_completion(payload, model, user, **kwargs)
+    elif _get_type_of_model(model) == ModelType.COMP:
+        payload = _completion_payload_from_messages(messages)
+        tokens = _strip_role_prefix(_stream_completion(payload, model, user, **kwargs))
+    else:
+        raise TypeError(f"Model not supported: {model}")
+    buffer = lang.SentenceBuffer()
+    async with contextlib.aclosing(tokens):
+        async for token in tokens:
+            for sentence in buffer.push(token):
+                if sentence.strip():
+                    yield sentence
+    if (sentence := buffer.flush()).strip():
+        yield sentence
@@ -1,7 +1,11 @@
 """This module implements the core WebRTCChatter class for use in the WebRTC server."""
 import asyncio
+import contextlib
 import itertools
+import os
 import textwrap
+import time
+from typing import AsyncIterator, Awaitable, Callable
 
 import aiortc
 from aiortc import RTCDataChannel
@@ -16,7 +20,8 @@ from moshi import (
     utils,
 )
 from moshi.core import activities
-from moshi.utils import ctx
+from moshi.core.base import Profile, User
+from moshi.utils import ctx, metrics
 from . import (
     detector,
     responder,
@@ -27,7 +32,18 @@ MAX_RESPONSE_TOKENS = 64
 MAX_LOOPS = 25
 STOP_TOKENS = ["1:"]  # USER is 1, ASSISTANT is 2
 UTT_START_MAX_COUNT = 2
+UTT_TRIM_SILENCE = int(os.getenv("MOSHITRIMSILENCE", 1))  # trim silence from the ends of utterances before transcription.
+UTT_MAX_PAUSE_SEC = float(os.getenv("MOSHIMAXPAUSESEC", 0))  # if nonzero, shorten pauses longer than this within utterances.
+TTS_STREAMING = int(os.getenv("MOSHITTSSTREAMING", 1))  # synthesize sentence by sentence and play as audio arrives.
+LLM_STREAMING = int(os.getenv("MOSHILLMSTREAMING", 1))  # with TTS_STREAMING, synthesize sentences while the LLM generates.
+LATENCY_INFO = int(os.getenv("MOSHILATENCYINFO", 0))  # send each turn's stage latencies to the client as info messages.
+BARGE_IN = int(os.getenv("MOSHIBARGEIN", 0))  # listen while responding; stop the response when the user starts speaking.
+SPECULATIVE_TRANSCRIPTION = int(os.getenv("MOSHISPECULATIVETRANSCRIPTION", 0))  # transcribe segments while the user speaks.
+UNSPACED_LANGS = {"ja", "cmn", "zh", "yue"}  # languages written without spaces between words.
 assert MAX_LOOPS >= 0
+logger.info(f"Using TTS_STREAMING={TTS_STREAMING}, LLM_STREAMING={LLM_STREAMING}")
+logger.info(f"Using BARGE_IN={BARGE_IN}, SPECULATIVE_TRANSCRIPTION={SPECULATIVE_TRANSCRIPTION}")
+logger.info(f"Using UTT_TRIM_SILENCE={UTT_TRIM_SILENCE}, UTT_MAX_PAUSE_SEC={UTT_MAX_PAUSE_SEC}")
 
 logger.success("Loaded!")
 
@@ -35,11 +51,22 @@ logger.success("Loaded!")
 class WebRTCAdapter:
     """This adapter connects WebRTC audio and signalling to the activity."""
 
-    def __init__(self, activity_type: activities.ActivityType):
+    def __init__(
+        self,
+        activity_type: activities.ActivityType,
+        user: User | None = None,
+        profile: Profile | None = None,
+        authorization: Awaitable[tuple[User, Profile]] | None = None,
+    ):
+        self.user = user  # NOTE if unset, start() uses the caller's ctx.user and ctx.profile.
+        self.profile = profile
+        self.__authorization = authorization  # NOTE resolves to (user, profile); start() waits for it.
         self.__dc = None
         self.__dc_connected = asyncio.Event()
         self.__task = None
         self.__utt_start_count = 0
+        self.__turn = None
+        self.turns: list[dict[str, float]] = []  # stage latencies of each completed turn, in seconds.
         self.act = activities.Activity(activity_type=activity_type)
         self.detector = (
             detector.UtteranceDetector()
@@ -47,6 +74,17 @@ class WebRTCAdapter:
         self.responder = (
             responder.ResponsePlayer()
         )  # play_response: AudioFrame -> track
+        self.__barge_in = bool(BARGE_IN)
+        if self.__barge_in and self.detector.mode != "vad":
+            logger.warning(f"Barge-in requires the detector's vad mode, not {self.detector.mode}; disabled.")
+            self.__barge_in = False
+        self.__speculative = bool(SPECULATIVE_TRANSCRIPTION)
+        if self.__speculative and self.detector.mode != "vad":
+            logger.warning(
+                f"Speculative transcription requires the detector's vad mode, not {self.detector.mode}; disabled."
+            )
+            self.__speculative = False
+        self.__segments: list[asyncio.Task] = []  # transcriptions of the current utterance's segments, in order.
 
     def __send(self, msg: str):
         """Send msg over dc with best effort."""
@@ -86,9 +124,23 @@ class WebRTCAdapter:
         await asyncio.sleep(0)
 
     async def start(self):
+        """Start the activity and the main chat task, once the call's authorization (if any) has resolved.
+        Raises:
+            - whatever the authorization raises, e.g. HTTPException if the user isn't allowed to call.
+        """
         if self.__task:
             logger.debug("Already started, no-op.")
             return
+        if self.__authorization is not None:
+            logger.debug("Awaiting authorization...")
+            self.user, self.profile = await self.__authorization
+            if self.__task:  # NOTE started concurrently while authorizing.
+                logger.debug("Already started, no-op.")
+                return
+        if self.user is not None:
+            ctx.user.set(self.user)  # NOTE the chat task and activity inherit this context.
+        if self.profile is not None:
+            ctx.profile.set(self.profile)
         self.__task = asyncio.create_task(self.__run(), name="Main chat task")
         logger.debug("Awaiting component startup...")
         results = await asyncio.gather(
@@ -118,8 +170,21 @@ class WebRTCAdapter:
         for i, result in enumerate(results):
             if isinstance(result, Exception):
                 logger.error(f"Task {i} raised exception: {result}")
+        self.__log_latency_summary()
         logger.info("Stopped")
 
+    def __log_latency_summary(self):
+        if not self.turns:
+            return
+        stages = {stage for turn in self.turns for stage in turn}
+        summary = {
+            stage: round(sum(vals) / len(vals), 3)
+            for stage in sorted(stages)
+            if (vals := [turn[stage] for turn in self.turns if stage in turn])
+        }
+        with logger.contextualize(turns=len(self.turns), **summary):
+            logger.info("Mean stage latency per turn (sec)")
+
     async def wait_dc_connected(self):
         logger.trace("pc connected, awaiting dc...")
         await asyncio.wait_for(self.__dc_connected.wait(), timeout=2)
@@ -172,6 +237,7 @@ class WebRTCAdapter:
                 self._send_status("maxlen")
                 break
             logger.debug(f"Starting loop {i}")
+            metrics.counter("moshi_adapter_loops_total", "Conversation turns started by WebRTC adapters.").inc()
             with logger.contextualize(i=i):
                 self._send_status("loopstart")
             try:
@@ -196,6 +262,7 @@ class WebRTCAdapter:
                 logger.error(traceback.format_exc())
                 self._send_error("internal")
                 break
+        self.__cancel_segments()
         utils.log.splash("bye")
 
     async def __main(self):
@@ -205,9 +272,13 @@ class WebRTCAdapter:
             - MediaStreamError when connection error or user hangup (disconnect).
         """
         self._send_status("listening")
+        self.__cancel_segments()
         try:
             # Raises: MediaStreamError, TimeoutError, UtteranceTooLongError, UtteranceNotStartedError
-            usr_audio: AudioFrame = await self.detector.get_utterance()
+            usr_audio: AudioFrame = await self.detector.get_utterance(
+                on_segment=self.__transcribe_segment if self.__speculative else None
+            )
+            turn = self.__turn = metrics.TurnTimer()
         except detector.UtteranceTooLongError as e:
             logger.debug("User utterance too long, prompting user to try again.")
             # self._send_error("uttTooLong")  # NOTE unhandled errors on the client side cause a hang-up!
@@ -222,8 +293,19 @@ class WebRTCAdapter:
             self.__utt_start_count += 1
             return
 
+        turn.record("utterance", utils.audio.get_frame_seconds(usr_audio))
+        if self.detector.endpoint_delay is not None:
+            turn.record("endpoint", self.detector.endpoint_delay)
+        if UTT_TRIM_SILENCE:
+            usr_audio = utils.audio.trim_silence(
+                usr_audio, max_pause_sec=UTT_MAX_PAUSE_SEC or None
+            )
+            if usr_audio is None:
+                logger.debug("User utterance was silent, trying again.")
+                return
+
         # if usr_audio is very short, send a message to the user and try again
-        too_short = int(44100 * 0.2)   # NOTE openai's min is 0.1 seconds
+        too_short = int(usr_audio.rate * 0.2)   # NOTE openai's min is 0.1 seconds
         if usr_audio.samples < too_short:
             logger.error(f"User utterance too short: {usr_audio.samples}")
             # self._send_error("uttTooShort")
@@ -231,25 +313,54 @@ class WebRTCAdapter:
 
         self.__utt_start_count = 0
         self._send_status("transcribing")
-        usr_text: str = await self.__transcribe_audio(
-            usr_audio
-        )  # TODO handle network errors
+        with turn.stage("transcription"):
+            usr_text: str = await self.__transcribe_utterance(
+                usr_audio
+            )  # TODO handle network errors
         usr_msg = self.__add_message(usr_text, Role.USR)
         self._send_transcript(usr_msg)
         self._send_status("thinking")
-        ast_text: str = await self.__get_response()
+        respond = self.__respond_streaming() if TTS_STREAMING and LLM_STREAMING else self.__respond()
+        if self.__barge_in:
+            await self.__respond_interruptibly(respond)
+        else:
+            await respond
+        self.__end_turn()
+
+    async def __respond(self):
+        """Get the assistant's whole response from the LLM, add it to the transcript, then speak it.
+        Raises:
+            - UserResetError if the response is empty or the audio track times out.
+        """
+        turn = self.__turn
+        with turn.stage("completion"):
+            ast_text: str = await self.__get_response()
         if ast_text:
             ast_msg = self.__add_message(ast_text, Role.AST)
             self._send_transcript(ast_msg)
             self._send_status("speaking")
-            ast_audio: AudioFrame = (
-                await self.__synth_speech()
-            )  # TODO handle network errors
-            logger.debug(f"Got assistant response audio: {ast_audio}, sending...")
             try:
-                await self.responder.send_utterance(
-                    ast_audio
-                )  # TODO handle: Raises: MediaStreamError
+                if TTS_STREAMING:
+                    synth_start = time.monotonic()
+                    frames = self.__timed_frames(self.__synth_speech_stream(), lambda: synth_start)
+                    try:
+                        await self.responder.send_utterance_stream(
+                            frames
+                        )  # TODO handle: Raises: MediaStreamError
+                        turn.record("playback", turn.since("first_audio"))
+                    finally:
+                        await frames.aclose()
+                else:
+                    with turn.stage("synthesis"):
+                        ast_audio: AudioFrame = (
+                            await self.__synth_speech()
+                        )  # TODO handle network errors
+                    logger.debug(f"Got assistant response audio: {ast_audio}, sending...")
+                    turn.mark("first_audio")
+                    with turn.stage("playback"):
+                        await self.responder.send_utterance(
+                            ast_audio
+                        )  # TODO handle: Raises: MediaStreamError
             except asyncio.TimeoutError as e:
                 logger.debug(f"TimeoutError: {e}")
                 raise UserResetError("timeout") from e
@@ -257,6 +368,120 @@ class WebRTCAdapter:
             logger.warning("Got empty assistant response")
             raise UserResetError("empty assistant response")
 
+    async def __respond_interruptibly(self, respond: Awaitable[None]):
+        """Respond while listening to the user. If they start speaking, stop the response; the next loop's utterance
+        starts from their speech onset. With LLM_STREAMING, only the sentences that began playing are kept in the
+        transcript; otherwise the whole response was added before playback began, and it stays.
+        Raises:
+            - UserResetError as the response does.
+            - MediaStreamError if the user hangs up.
+        """
+        response = asyncio.create_task(respond)
+        onset = asyncio.create_task(self.detector.wait_speech_onset())
+        try:
+            await asyncio.wait({response, onset}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            response.cancel()
+            onset.cancel()
+            await asyncio.gather(response, onset, return_exceptions=True)
+            raise
+        if onset.done() and not response.done():
+            response.cancel()
+        else:
+            onset.cancel()
+        await asyncio.gather(response, onset, return_exceptions=True)
+        if response.cancelled():
+            onset.result()  # NOTE raises MediaStreamError if the user hung up.
+            logger.info("User interrupted the response.")
+            self.responder.flush()
+            self.__turn.mark("interrupted")
+            metrics.counter("moshi_barge_ins_total", "Responses interrupted by the user speaking.").inc()
+            return
+        response.result()
+
+    def __end_turn(self):
+        """Keep the completed turn's stage latencies and, if configured, send them to the client."""
+        turn = self.__turn
+        self.turns.append(turn.stages)
+        if LATENCY_INFO:
+            for stage, seconds in turn.stages.items():
+                self._send_info(f"latency.{stage}", f"{seconds:.3f}")
+
+    async def __timed_frames(
+        self, frames: AsyncIterator[AudioFrame], synth_start: Callable[[], float]
+    ) -> AsyncIterator[AudioFrame]:
+        """Pass the frames through, timing the synthesis of the first one (from synth_start(), called when it
+        arrives) and how long they all take to play.
+        """
+        turn = self.__turn
+        first = None
+        async with contextlib.aclosing(frames):
+            async for frame in frames:
+                if first is None:
+                    first = time.monotonic()
+                    turn.record("synthesis", first - synth_start())
+                    turn.mark("first_audio")
+                yield frame
+
+    async def __respond_streaming(self):
+        """Stream the assistant's response from the LLM into speech, synthesizing each sentence as soon as it has been
+        generated. Once the response is complete, or interrupted, the sentences whose audio began playing are added to
+        the transcript; sentences generated but never played, e.g. flushed on barge-in, are left out.
+        Raises:
+            - UserResetError if the response is empty or the audio track times out.
+        """
+        turn = self.__turn
+        sentences = []
+        starts = []  # NOTE synthesize_stream yields one frame per sentence, in order; this is where each one starts.
+        played = self.responder.played_samples
+        synth_start = None
+
+        async def _sentences():
+            nonlocal synth_start
+            t0 = time.monotonic()
+            async with contextlib.aclosing(self.__get_response_stream()) as stream:
+                async for sentence in stream:
+                    if not sentences:
+                        synth_start = time.monotonic()
+                        turn.record("completion", synth_start - t0)
+                        self._send_status("speaking")
+                    sentences.append(sentence)
+                    yield sentence.strip()
+
+        async def _offsets(frames: AsyncIterator[AudioFrame]) -> AsyncIterator[AudioFrame]:
+            offset = 0
+            async with contextlib.aclosing(frames):
+                async for frame in frames:
+                    starts.append(offset)
+                    offset += frame.samples
+                    yield frame
+
+        # NOTE closed explicitly, as synthesize_stream may stop iterating them midway, e.g. on barge-in.
+        generated = _sentences()
+        frames = _offsets(
+            self.__timed_frames(utils.speech.synthesize_stream(generated, self.voice), lambda: synth_start)
+        )
+        try:
+            await self.responder.send_utterance_stream(
+                frames
+            )  # TODO handle: Raises: MediaStreamError
+            if "first_audio" in turn.stages:
+                turn.record("playback", turn.since("first_audio"))
+        except asyncio.TimeoutError as e:
+            logger.debug(f"TimeoutError: {e}")
+            raise UserResetError("timeout") from e
+        finally:
+            await frames.aclose()
+            await generated.aclose()
+            played = self.responder.played_samples - played
+            spoken = sum(start < played for start in starts)
+            if ast_text := "".join(sentences[:spoken]).strip():
+                ast_msg = self.__add_message(ast_text, Role.AST)
+                self._send_transcript(ast_msg)
+        if not ast_text:
+            logger.warning("Got empty assistant response")
+            raise UserResetError("empty assistant response")
+
     def __add_message(self, content: str, role: Role) -> Message:
         assert isinstance(content, str)
         if not isinstance(role, Role):
@@ -275,12 +500,18 @@ class WebRTCAdapter:
         assert isinstance(frame, AudioFrame)
         return frame
 
-    async def __get_response(self):
-        """Retrieve the chatbot's response to the user utterance."""
-        logger.debug(f"Getting assistant response...")
-        ast_txts: str = await think.completion_from_assistant(
-            self.messages,
-            n=1,
+    async def __synth_speech_stream(self) -> AsyncIterator[AudioFrame]:
+        """Synthesize the latest assistant message sentence by sentence."""
+        msg = self.messages[-1]
+        assert msg.role == Role.AST
+        sentences = utils.lang.split_sentences(msg.content)
+        logger.debug(f"Synthesizing {len(sentences)} sentences to speech: {msg}")
+        async for frame in utils.speech.synthesize_stream(sentences, self.voice):
+            logger.debug(f"Sentence synthesized: {frame}")
+            yield frame
+
+    def __completion_kwargs(self) -> dict:
+        return dict(
             max_tokens=MAX_RESPONSE_TOKENS,
             stop=STOP_TOKENS,
             user=ctx.user.get().uid,
@@ -289,14 +520,70 @@ class WebRTCAdapter:
             # temperature=1.6,
             top_p=0.9,
         )
+
+    async def __get_response_stream(self) -> AsyncIterator[str]:
+        """Stream the chatbot's response to the user utterance a sentence at a time."""
+        logger.debug(f"Streaming assistant response...")
+        async with contextlib.aclosing(
+            think.stream_completion_from_assistant(self.messages, **self.__completion_kwargs())
+        ) as stream:
+            async for sentence in stream:
+                logger.debug(f"Got assistant sentence: {textwrap.shorten(sentence, 64)}")
+                yield sentence
+
+    async def __get_response(self):
+        """Retrieve the chatbot's response to the user utterance."""
+        logger.debug(f"Getting assistant response...")
+        ast_txts: str = await think.completion_from_assistant(
+            self.messages, n=1, **self.__completion_kwargs()
+        )
         assert len(ast_txts) == 1
         ast_txt = ast_txts[0]
         logger.debug(f"Got assistant response: {textwrap.shorten(ast_txt, 64)}")
         return ast_txt
 
-    async def __transcribe_audio(self, audio, role=Role.USR):
+    def __transcribe_segment(self, segment: AudioFrame):
+        """Start transcribing a segment of the user's utterance while they're still speaking. Each segment is prompted
+        with the transcript of the one before, for continuity across the cut.
+        """
+        previous = self.__segments[-1] if self.__segments else None
+
+        async def _transcribe() -> str:
+            prompt = await previous if previous is not None else None
+            seg = utils.audio.trim_silence(segment) if UTT_TRIM_SILENCE else segment
+            if seg is None or seg.samples < seg.rate * 0.1:  # NOTE openai's min is 0.1 seconds
+                return ""
+            return await self.__transcribe_audio(seg, prompt=prompt)
+
+        self.__segments.append(asyncio.create_task(_transcribe()))
+
+    def __cancel_segments(self):
+        for task in self.__segments:
+            task.cancel()
+        self.__segments = []
+
+    async def __transcribe_utterance(self, usr_audio: AudioFrame) -> str:
+        """Join the transcripts of the utterance's segments, most of which are done by the time the user stops speaking.
+        If the utterance wasn't segmented, or a segment fails, transcribe the whole utterance.
+        """
+        segments, self.__segments = self.__segments, []
+        if segments:
+            try:
+                texts = await asyncio.gather(*segments)
+            except Exception as e:
+                logger.warning(f"Speculative transcription failed, transcribing the whole utterance: {e}")
+                for task in segments:
+                    task.cancel()
+            else:
+                sep = "" if self.language in UNSPACED_LANGS else " "
+                transcript = sep.join(text.strip() for text in texts if text.strip())
+                logger.debug(f"Joined transcripts of {len(segments)} segments: {textwrap.shorten(transcript, 64)}")
+                return transcript
+        return await self.__transcribe_audio(usr_audio)
+
+    async def __transcribe_audio(self, audio, role=Role.USR, prompt: str = None):
         logger.debug(f"Transcribing {role.value} audio: {audio}")
-        transcript: str = await utils.speech.transcribe(audio, language=self.language)
+        transcript: str = await utils.speech.transcribe(audio, language=self.language, prompt=prompt)
         logger.debug(
             f"Transcribed {role.value} utterance: {textwrap.shorten(transcript, 64)}"
         )
@@ -3,6 +3,7 @@ from abc import ABC, abstractmethod
 import asyncio
 import dataclasses
 import datetime
+import os
 from enum import Enum
 from typing import Annotated, Literal, Union
 
@@ -13,9 +14,21 @@ from .base import Message, Role
 from .character import Character
 from moshi import __version__ as moshi_version
 from moshi.utils.storage import firestore_client
-from moshi.utils import speech, ctx, lang
+from moshi.utils import cache, speech, ctx, lang, metrics, storage
+
+TRANSCRIPT_DEBOUNCE_SEC = float(os.getenv("MOSHITRANSCRIPTDEBOUNCESEC", 2.0))
+logger.info(f"Using transcript write debounce: {TRANSCRIPT_DEBOUNCE_SEC} sec")
+# document: rewrite the whole transcript doc on each save; append: write the header doc once and each message once to
+# its "messages" subcollection, with zero-padded ids in conversation order.
+TRANSCRIPT_STORAGE = os.getenv("MOSHITRANSCRIPTSTORAGE", "document")
+assert TRANSCRIPT_STORAGE in {"document", "append"}, f"Unsupported transcript storage: {TRANSCRIPT_STORAGE}"
+logger.info(f"Using transcript storage: {TRANSCRIPT_STORAGE}")
+FIRESTORE_BATCH_SIZE = 500  # NOTE max writes per batch
 
 transcript_col = firestore_client.collection("transcripts")
+translated_prompt_col = firestore_client.collection("translated_prompts")
+config_col = firestore_client.collection("config")
+translated_prompts: dict[str, list[tuple[str, str]]] = {}
 
 
 @dataclasses.dataclass
@@ -30,6 +43,10 @@ class Transcript:
     def asdict(self) -> dict:
         return dataclasses.asdict(self)
 
+    def header(self) -> dict:
+        """Everything but the messages."""
+        return {f.name: getattr(self, f.name) for f in dataclasses.fields(self) if f.name != "messages"}
+
     def __post_init__(self):
         self.timestamp = self.timestamp or datetime.datetime.now()
 
@@ -43,6 +60,9 @@ class BaseActivity(ABC, BaseModel):
 
     activity_type: ActivityType
     __update_transcript_task: asyncio.Task = None
+    __writing: bool = False
+    __saved_count: int = 0  # number of messages persisted
+    __created: bool = False  # whether the conversation document exists
     __transcript: Transcript = None
     __cid: str = None
     __character: Character = None
@@ -68,38 +88,65 @@ class BaseActivity(ABC, BaseModel):
     def cid(self):
         return self.__cid
 
+    @property
+    def dirty(self) -> bool:
+        return self.__saved_count < len(self.__transcript.messages)
+
     def add_msg(self, msg: Message):
+        """Add the message to the transcript, persisting it with best effort after TRANSCRIPT_DEBOUNCE_SEC. Messages
+        added while a write is pending are coalesced into the next write.
+        """
         self.__transcript.messages.append(msg)
+        if self.__update_transcript_task and not self.__update_transcript_task.done():
+            logger.debug("Coalescing message into pending transcript write.")
+            metrics.counter(
+                "moshi_transcript_coalesced_messages_total", "Messages persisted by an already pending transcript write."
+            ).inc()
+            return
         logger.debug("Updating transcript in Firestore with best effort.")
-        if self.__update_transcript_task:
-            if self.__update_transcript_task.cancel():
-                logger.warning("Cancelled previous update transcript task.")
-        self.__update_transcript_task = asyncio.create_task(self.__save())
+        self.__update_transcript_task = asyncio.create_task(self.__write_behind(), name="Write transcript")
+
+    async def __write_behind(self):
+        """Save the transcript until it's clean, debouncing each write. One per activity at a time."""
+        while self.dirty:
+            await asyncio.sleep(TRANSCRIPT_DEBOUNCE_SEC)
+            self.__writing = True
+            try:
+                await self.__save()
+            except Exception as e:
+                logger.error(f"Failed to save transcript, will retry on next message or stop: {e}")
+                return
+            finally:
+                self.__writing = False
 
     @logger.catch
     async def start(self):
         await asyncio.gather(
             self.__init_transcript(),
             self.__init_character(),
+            self.__count_conversation(),
             )
         logger.success("Activity started!")
 
     async def stop(self):
         """Save the transcript to Firestore."""
         logger.info("Stopping activity...")
-        if self.__update_transcript_task:
-            if self.__update_transcript_task.cancel():
-                logger.warning("Cancelled previous update transcript task.")
-        logger.debug("Saving transcript to Firestore...")
-        await self.__save()
-        logger.debug("Saved transcript to Firestore.")
+        if (task := self.__update_transcript_task) and not task.done():
+            if self.__writing:
+                logger.debug("Waiting for in-flight transcript write...")
+                await asyncio.wait([task])
+            else:
+                task.cancel()  # NOTE only debouncing, the final save below covers it.
+        if self.__transcript is not None and (self.dirty or not self.__created):
+            logger.debug("Saving transcript to Firestore...")
+            await self.__save()
+            logger.debug("Saved transcript to Firestore.")
         logger.success("Activity stopped!")
 
     async def _translate_prompt(self) -> list[Message]:
         """Translate the prompt into the user's target language. Timeout handled by caller. Requires a profile to be set."""
         logger.trace("Translating prompt...")
-        prompt = self._prompt()
-        prompt = await lang.translate_messages(prompt, ctx.profile.get().lang)
+        prompt = await get_translated_prompt(self.activity_type, self._prompt(), ctx.profile.get().lang)
         logger.trace(f"Translated prompt: {prompt}")
         return prompt
 
@@ -117,6 +164,13 @@ class BaseActivity(ABC, BaseModel):
         await self.__save()
         logger.trace(f"Transcript initialized.")
 
+    async def __count_conversation(self):
+        """Count this conversation against the user's daily limit, with best effort."""
+        try:
+            await storage.increment_daily_convo_count(ctx.user.get().uid)
+        except Exception as e:
+            logger.error(f"Failed to count conversation: {e}")
+
     async def __init_character(self):
         """Initialize the character for this conversation."""
         logger.debug(f"Creating character...")
@@ -138,11 +192,32 @@ class BaseActivity(ABC, BaseModel):
             self.__cid = doc_ref.id
         with logger.contextualize(cid=self.__cid):
             logger.debug(f"Saving conversation document...")
-            try:
-                await doc_ref.set(self.__transcript.asdict())
-                logger.success(f"Saved conversation document!")
-            except asyncio.CancelledError:
-                logger.debug(f"Cancelled saving conversation document.")
+            count = len(self.__transcript.messages)
+            with metrics.track_api("firestore_transcript"):
+                if TRANSCRIPT_STORAGE == "append":
+                    await self.__append(doc_ref, count)
+                else:
+                    await doc_ref.set(self.__transcript.asdict())
+            self.__created = True
+            self.__saved_count = max(self.__saved_count, count)
+            metrics.counter("moshi_transcript_writes_total", "Transcript writes to Firestore.").inc()
+            logger.success(f"Saved conversation document!")
+
+    async def __append(self, doc_ref, count: int):
+        """Write the header if it's new, and the messages not yet persisted. Each message is written once, so bytes
+        written per save don't grow with the conversation.
+        NOTE not ArrayUnion, which drops messages equal to one already in the array.
+        """
+        writes = [] if self.__created else [(doc_ref, {**self.__transcript.header(), "storage": "append"})]
+        messages_col = doc_ref.collection("messages")
+        for i in range(self.__saved_count, count):
+            msg = self.__transcript.messages[i]
+            writes.append((messages_col.document(f"{i:06d}"), dataclasses.asdict(msg)))
+        for start in range(0, len(writes), FIRESTORE_BATCH_SIZE):
+            batch = firestore_client.batch()
+            for ref, data in writes[start : start + FIRESTORE_BATCH_SIZE]:
+                batch.set(ref, data)
+            await batch.commit()
 
 
 class Unstructured(BaseActivity):
@@ -170,6 +245,59 @@ class Unstructured(BaseActivity):
         return messages
 
 
+def _translated_prompt_id(activity_type: str, prompt: list[Message], target: str) -> str:
+    prompt_hash = cache.digest(*(f"{msg.role}:{msg.content}" for msg in prompt))
+    return f"{ActivityType(activity_type).value}_{target}_{prompt_hash}"
+
+
+async def get_translated_prompt(activity_type: str, prompt: list[Message], target: str) -> list[Message]:
+    """Get the prompt translated into the target language, translating it only if it's in neither the in-process cache
+    nor Firestore. Returns new messages, safe to append to.
+    """
+    doc_id = _translated_prompt_id(activity_type, prompt, target)
+    if (cached := translated_prompts.get(doc_id)) is None:
+        try:
+            doc = await translated_prompt_col.document(doc_id).get()
+            if doc.exists:
+                cached = [(msg["role"], msg["content"]) for msg in doc.to_dict()["messages"]]
+        except Exception as e:
+            logger.warning(f"Failed to read translated prompt {doc_id}: {e}")
+    if cached is None:
+        logger.debug(f"Translating {activity_type} prompt to {target}...")
+        translated = await lang.translate_messages(prompt, target)
+        cached = [(msg.role, msg.content) for msg in translated]
+        try:
+            await translated_prompt_col.document(doc_id).set(
+                {
+                    "activity_type": ActivityType(activity_type).value,
+                    "language": target,
+                    "messages": [{"role": role, "content": content} for role, content in cached],
+                    "moshi_version": moshi_version,
+                }
+            )
+        except Exception as e:
+            logger.warning(f"Failed to save translated prompt {doc_id}: {e}")
+    translated_prompts[doc_id] = cached
+    return [Message(Role(role), content) for role, content in cached]
+
+
+async def precompute_translated_prompts():
+    """Translate every activity's prompt into every supported language, so conversations don't wait on translation."""
+    doc = await config_col.document("supported_langs").get()
+    targets = doc.to_dict().get("langs", []) if doc.exists else []
+    activities = [act_cls() for act_cls in BaseActivity.__subclasses__()]
+    prompts = [(act.activity_type, act._prompt()) for act in activities]
+    logger.debug(f"Precomputing {len(prompts)} prompts in {len(targets)} languages...")
+    results = await asyncio.gather(
+        *(get_translated_prompt(activity_type, prompt, target) for activity_type, prompt in prompts for target in targets),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to precompute translated prompt: {result}")
+    logger.info(f"Precomputed {len(results)} translated prompts.")
+
+
 Activity = Annotated[
     Union[Unstructured, Unstructured], Field(discriminator="activity_type")
 ]
@@ -1,7 +1,8 @@
 """ This module provide audio processing utilities. """
+import contextlib
 import io
-import os
-import tempfile
+import struct
+import threading
 
 import av
 import numpy as np
@@ -15,6 +16,12 @@ AUDIO_LAYOUT = "stereo"
 logger.info(f"Using sample rate: {SAMPLE_RATE}")
 logger.info(f"Using audio format: {AUDIO_FORMAT}")
 logger.info(f"Using audio layout: {AUDIO_LAYOUT}")
+RESAMPLER_POOL_SIZE = 8  # idle resamplers kept per conversion.
+RESAMPLER_PAD_SEC = 0.005  # silence fed after each frame; must exceed the resampler's filter delay.
+MIN_NOISE_FLOOR = 30.0  # RMS; keeps digital silence from making any sound at all look like speech.
+TRIM_WINDOW_SEC = 0.02  # silence is trimmed at this granularity.
+TRIM_SPEECH_RATIO = 3.0  # windows this many times louder than the utterance's noise floor are speech.
+TRIM_PAD_SEC = 0.15  # keep this much audio around the speech so soft onsets and tails aren't clipped.
 
 logger.success("Loaded!")
 
@@ -24,13 +31,58 @@ def track_str(track: MediaStreamTrack) -> str:
     return f"{track.readyState}:{track.kind}:{track.id}"
 
 
-@logger.catch
-def make_resampler():
-    return AudioResampler(
-        format=AUDIO_FORMAT,
-        layout=AUDIO_LAYOUT,
-        rate=SAMPLE_RATE,
-    )
+_resamplers: dict[tuple, list[AudioResampler]] = {}
+_resamplers_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def pooled_resampler(
+    frame: AudioFrame, format: str = AUDIO_FORMAT, layout: str = AUDIO_LAYOUT, rate: int = SAMPLE_RATE
+):
+    """Borrow a resampler from the pool for converting frames like this one to the given format, layout, and rate.
+    Resamplers are configured by the first frame they see, so the pool is keyed by the source format as well.
+    Safe to use from multiple threads; each resampler is only used by one borrower at a time.
+    """
+    key = (frame.format.name, frame.layout.name, frame.rate, format, layout, rate)
+    with _resamplers_lock:
+        idle = _resamplers.setdefault(key, [])
+        res = idle.pop() if idle else None
+    if res is None:
+        logger.debug(f"Creating resampler for: {key}")
+        res = AudioResampler(format=format, layout=layout, rate=rate)
+    try:
+        yield res
+    finally:
+        with _resamplers_lock:
+            if len(idle) < RESAMPLER_POOL_SIZE:
+                idle.append(res)
+
+
+def resample_frame(
+    frame: AudioFrame, format: str = AUDIO_FORMAT, layout: str = AUDIO_LAYOUT, rate: int = SAMPLE_RATE
+) -> AudioFrame:
+    """Resample a whole frame with a pooled resampler.
+    Flushing a resampler ends it, so instead, when the rate changes, a little silence is fed after the frame: that
+    pushes the whole frame through the filter, and what the filter carries over into its next use is silence rather
+    than the tail of this frame.
+    """
+    fifo = AudioFifo()
+    with pooled_resampler(frame, format, layout, rate) as res:
+        outs = res.resample(frame)
+        if frame.rate != rate:
+            pad = AudioFrame(
+                format=frame.format.name,
+                layout=frame.layout.name,
+                samples=int(frame.rate * RESAMPLER_PAD_SEC),
+            )
+            for plane in pad.planes:
+                plane.update(bytes(plane.buffer_size))
+            pad.rate = frame.rate
+            outs += res.resample(pad)
+    for out in outs:
+        out.pts = None
+        fifo.write(out)
+    return fifo.read()
 
 
 def get_frame_energy(af: AudioFrame) -> float:
@@ -43,6 +95,177 @@ def get_frame_energy(af: AudioFrame) -> float:
     return energy
 
 
+def frame_pcm(af: AudioFrame) -> np.ndarray:
+    """Zero-copy view of the interleaved s16 PCM in a packed audio frame."""
+    if af.format.name != "s16":
+        raise ValueError(f"Only packed s16 frames supported, got: {af.format.name}")
+    return np.frombuffer(
+        af.planes[0], dtype=np.int16, count=af.samples * len(af.layout.channels)
+    )
+
+
+class PCMRingBuffer:
+    """Ring buffer of interleaved s16 PCM with batched, in-place per-window statistics.
+    Positions are absolute sample counts (per channel) since the buffer was created; the last `capacity` samples are
+    retained. Windows are aligned to the start of the ring so they never wrap.
+    The ring starts at initial_sec and doubles as it fills, up to `capacity`; it only wraps once fully grown.
+    """
+
+    def __init__(
+        self,
+        capacity_sec: float,
+        window: int = 960,
+        channels: int = 2,
+        rate: int = SAMPLE_RATE,
+        max_batch: int = 8,
+        initial_sec: float = 1.0,
+    ):
+        self.window = window
+        self.channels = channels
+        self.rate = rate
+        self.capacity = -(-int(capacity_sec * rate) // window) * window
+        self.written = 0
+        self.analyzed = 0
+        self.__size = min(self.capacity, max(window, -(-int(initial_sec * rate) // window) * window))
+        self.__buf = np.zeros(self.__size * channels, dtype=np.int16)
+        self.__max_batch = max_batch
+        self.__scratch = np.empty((max_batch, window * channels), dtype=np.float32)
+        self.__sign = np.empty((max_batch, window), dtype=bool)
+        self.__cross = np.empty((max_batch, window - 1), dtype=bool)
+        self.__rms = np.empty(max_batch, dtype=np.float32)
+        self.__zcr = np.empty(max_batch, dtype=np.float32)
+
+    @property
+    def window_sec(self) -> float:
+        return self.window / self.rate
+
+    @property
+    def pending(self) -> int:
+        """Number of complete windows written but not yet analyzed."""
+        return (self.written - self.analyzed) // self.window
+
+    @property
+    def oldest(self) -> int:
+        """Position of the oldest sample still in the buffer."""
+        return max(0, self.written - self.capacity)
+
+    def __grow(self, samples: int):
+        """Grow the ring to hold at least `samples`, up to capacity. It hasn't wrapped yet, so its PCM is a prefix."""
+        size = min(self.capacity, max(2 * self.__size, -(-samples // self.window) * self.window))
+        buf = np.zeros(size * self.channels, dtype=np.int16)
+        buf[: len(self.__buf)] = self.__buf
+        self.__buf, self.__size = buf, size
+
+    def write(self, af: AudioFrame):
+        """Copy the frame's PCM into the ring."""
+        if af.rate != self.rate or len(af.layout.channels) != self.channels:
+            raise ValueError(
+                f"Expected {self.channels} channels at {self.rate} Hz, got: {af.layout.name} at {af.rate} Hz"
+            )
+        pcm = frame_pcm(af)
+        if af.samples > self.capacity:
+            pcm = pcm[-self.capacity * self.channels :]
+            self.written += af.samples - self.capacity
+        if self.__size < self.capacity and self.written + len(pcm) // self.channels > self.__size:
+            self.__grow(self.written + len(pcm) // self.channels)
+        start = (self.written % self.__size) * self.channels
+        head = min(len(pcm), len(self.__buf) - start)
+        self.__buf[start : start + head] = pcm[:head]
+        self.__buf[: len(pcm) - head] = pcm[head:]
+        self.written += len(pcm) // self.channels
+
+    def analyze(self) -> tuple[np.ndarray, np.ndarray]:
+        """Compute the RMS energy and zero-crossing rate (of the first channel) of complete windows written since the
+        last call, at most max_batch of them; unanalyzed windows that were overwritten are skipped.
+        Returns views into preallocated arrays, valid until the next call.
+        """
+        self.analyzed = max(self.analyzed, -(-self.oldest // self.window) * self.window)
+        n = min((self.written - self.analyzed) // self.window, self.__max_batch)
+        if n == 0:
+            return self.__rms[:0], self.__zcr[:0]
+        start = (self.analyzed % self.__size) * self.channels
+        n = min(n, (len(self.__buf) - start) // (self.window * self.channels))
+        pcm = self.__buf[start : start + n * self.window * self.channels].reshape(n, -1)
+        scratch, rms, zcr = self.__scratch[:n], self.__rms[:n], self.__zcr[:n]
+        np.copyto(scratch, pcm, casting="unsafe")
+        np.einsum("ij,ij->i", scratch, scratch, out=rms)
+        np.divide(rms, self.window * self.channels, out=rms)
+        np.sqrt(rms, out=rms)
+        sign, cross = self.__sign[:n], self.__cross[:n]
+        np.signbit(pcm.reshape(n, self.window, self.channels)[:, :, 0], out=sign)
+        np.not_equal(sign[:, 1:], sign[:, :-1], out=cross)
+        np.add.reduce(cross, axis=1, out=zcr)
+        np.divide(zcr, self.window - 1, out=zcr)
+        self.analyzed += n * self.window
+        return rms, zcr
+
+    def read(self, start: int, stop: int) -> AudioFrame:
+        """Copy the samples in [start, stop) into a new frame."""
+        if not self.oldest <= start <= stop <= self.written:
+            raise ValueError(
+                f"Range [{start}, {stop}) not in buffer [{self.oldest}, {self.written})"
+            )
+        layout = "mono" if self.channels == 1 else "stereo"
+        frame = AudioFrame(format="s16", layout=layout, samples=stop - start)
+        frame.rate = self.rate
+        out = frame_pcm(frame)
+        i = (start % self.__size) * self.channels
+        head = min(len(out), len(self.__buf) - i)
+        out[:head] = self.__buf[i : i + head]
+        out[head:] = self.__buf[: len(out) - head]
+        return frame
+
+
+def trim_silence(
+    af: AudioFrame,
+    max_pause_sec: float | None = None,
+    keep_pause_sec: float = 0.3,
+    speech_ratio: float = TRIM_SPEECH_RATIO,
+    pad_sec: float = TRIM_PAD_SEC,
+) -> AudioFrame | None:
+    """Cut the silence from both ends of an utterance and, if max_pause_sec is set, shorten internal pauses longer than
+    that to keep_pause_sec. The noise floor is estimated from the quietest windows of the utterance itself.
+    Returns None if the frame is silent.
+    """
+    channels = len(af.layout.channels)
+    window = max(1, int(af.rate * TRIM_WINDOW_SEC))
+    n = af.samples // window
+    if n == 0:
+        return af
+    pcm = frame_pcm(af)
+    windows = pcm[: n * window * channels].reshape(n, -1).astype(np.float32)
+    energy = np.sqrt(np.mean(np.square(windows), axis=1))
+    noise_floor = max(np.percentile(energy, 10), MIN_NOISE_FLOOR)
+    speech = np.flatnonzero(energy >= speech_ratio * noise_floor)
+    if len(speech) == 0:
+        if energy.max() < speech_ratio * MIN_NOISE_FLOOR:
+            logger.debug("No speech found")
+            return None
+        logger.debug(f"Can't separate speech from noise floor {noise_floor:.3f}, not trimming")
+        return af
+    pad = int(pad_sec / TRIM_WINDOW_SEC)
+    first = max(0, speech[0] - pad)
+    last = min(n, speech[-1] + 1 + pad)
+    keep = np.zeros(n, dtype=bool)
+    keep[first:last] = True
+    if max_pause_sec is not None:
+        max_pause, half_keep = int(max_pause_sec / TRIM_WINDOW_SEC), int(keep_pause_sec / TRIM_WINDOW_SEC / 2)
+        for a, b in zip(speech[:-1], speech[1:]):
+            if b - a - 1 > max_pause:
+                keep[a + 1 + half_keep : b - half_keep] = False
+    tail = np.full(af.samples - n * window, last == n)  # the partial window at the end goes with the last window
+    keep = np.concatenate([np.repeat(keep, window), tail])
+    trimmed = pcm.reshape(-1, channels)[keep]
+    frame = AudioFrame.from_ndarray(
+        trimmed.reshape(1, -1), format=af.format.name, layout=af.layout.name
+    )
+    frame.rate = af.rate
+    logger.debug(
+        f"Trimmed utterance from {get_frame_seconds(af):.3f} sec to {get_frame_seconds(frame):.3f} sec"
+    )
+    return frame
+
+
 def get_frame_seconds(af: AudioFrame) -> float:
     """Calculate the length in seconds of an audio frame."""
     seconds = af.samples / af.rate
@@ -69,9 +292,98 @@ def empty_frame(
     return frame
 
 
+def pcm_bytes_to_audio_frame(pcm: bytes, layout=AUDIO_LAYOUT, rate=SAMPLE_RATE) -> AudioFrame:
+    """Build a packed s16 frame from interleaved PCM, e.g. from frame_pcm(af).tobytes()."""
+    samples = np.frombuffer(pcm, dtype="<i2").reshape(1, -1)
+    frame = AudioFrame.from_ndarray(samples, format="s16", layout=layout)
+    frame.rate = rate
+    return frame
+
+
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+
+def audio_frame_to_wav_bytes(frame: AudioFrame) -> bytes:
+    """Encode the frame as a WAV (pcm_s16le) bytestring in memory."""
+    if frame.format.name != "s16":
+        buf = io.BytesIO()
+        write_audio_frame_to_wav(frame, buf)
+        return buf.getvalue()
+    channels = len(frame.layout.channels)
+    pcm = memoryview(frame.planes[0])[: frame.samples * channels * 2]
+    header = WAV_HEADER.pack(
+        b"RIFF",
+        36 + len(pcm),
+        b"WAVE",
+        b"fmt ",
+        16,  # fmt chunk size
+        1,  # PCM
+        channels,
+        frame.rate,
+        frame.rate * channels * 2,  # byte rate
+        channels * 2,  # block align
+        16,  # bits per sample
+        b"data",
+        len(pcm),
+    )
+    return b"".join((header, pcm))
+
+
+def _parse_wav_pcm16(wav: bytes) -> tuple[int, int, memoryview] | None:
+    """Parse a WAV (LINEAR16) bytestring into (channels, rate, pcm).
+    Returns None if it isn't 16 bit PCM with a mono or stereo layout.
+    """
+    mv = memoryview(wav)
+    if len(mv) < 12 or mv[:4] != b"RIFF" or mv[8:12] != b"WAVE":
+        return None
+    fmt = None
+    i = 12
+    while i + 8 <= len(mv):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", mv, i)
+        body = mv[i + 8 : i + 8 + chunk_size]
+        if chunk_id == b"fmt " and len(body) >= 16:
+            fmt = struct.unpack_from("<HHIIHH", body)
+        elif chunk_id == b"data" and fmt is not None:
+            encoding, channels, rate, _, _, bits = fmt
+            if encoding != 1 or bits != 16 or channels not in {1, 2}:
+                return None
+            return channels, rate, body[: len(body) // (2 * channels) * 2 * channels]
+        i += 8 + chunk_size + chunk_size % 2
+    return None
+
+
+ENCODINGS = {  # encoding: (container format, codec)
+    "wav": ("wav", "pcm_s16le"),
+    "flac": ("flac", "flac"),
+    "opus": ("ogg", "libopus"),
+}
+
+
+def encode_audio_frame(
+    frame: AudioFrame, encoding: str = "wav", rate: int = 16000, layout: str = "mono"
+) -> bytes:
+    """Downmix and resample the frame, then encode it in memory as WAV, FLAC, or Opus (in Ogg)."""
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unsupported encoding: {encoding}, expected one of {list(ENCODINGS)}")
+    if frame.rate != rate or frame.layout.name != layout or frame.format.name != "s16":
+        frame = resample_frame(frame, format="s16", layout=layout, rate=rate)
+    if encoding == "wav":
+        return audio_frame_to_wav_bytes(frame)
+    container_format, codec = ENCODINGS[encoding]
+    buf = io.BytesIO()
+    with av.open(buf, "w", format=container_format) as container:
+        stream = container.add_stream(codec, rate=rate, layout=layout)
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buf.getvalue()
+
+
 def write_audio_frame_to_wav(frame: AudioFrame, output_file):
+    """Write the frame in WAV format to a file path or a writable file-like object."""
     # Source: https://stackoverflow.com/a/56307655/5298555
-    with av.open(output_file, "w") as container:
+    with av.open(output_file, "w", format="wav") as container:
         stream = container.add_stream("pcm_s16le")
         for packet in stream.encode(frame):
             container.mux(packet)
@@ -85,7 +397,8 @@ def write_bytes_to_wav_file(filename: str, bytestring: bytes):
         f.write(bytestring)
 
 
-def load_wav_to_buffer(fp: str) -> AudioFifo:
+def load_wav_to_buffer(fp) -> AudioFifo:
+    """Decode a WAV file from a file path or a readable file-like object."""
     with av.open(fp, "r") as container:
         fifo = AudioFifo()
         for frame in container.decode(audio=0):
@@ -93,17 +406,21 @@ def load_wav_to_buffer(fp: str) -> AudioFifo:
     return fifo
 
 
-def load_wav_to_audio_frame(fp: str) -> AudioFrame:
+def load_wav_to_audio_frame(fp) -> AudioFrame:
     frame = load_wav_to_buffer(fp).read()
-    res = make_resampler()
-    return res.resample(frame)[0]
+    return resample_frame(frame)
 
 
 def wav_bytes_to_audio_frame(wav: bytes) -> AudioFrame:
-    _, fp = tempfile.mkstemp()
-    try:
-        write_bytes_to_wav_file(fp, wav)
-        af = load_wav_to_audio_frame(fp)
-    finally:
-        os.remove(fp)
-    return af
+    """Decode a WAV bytestring into a single frame in the pipeline format. LINEAR16 WAV is parsed directly; other
+    encodings are decoded in memory with PyAV.
+    """
+    parsed = _parse_wav_pcm16(wav)
+    if parsed is None:
+        logger.debug("Not a 16 bit PCM WAV, decoding with PyAV")
+        return load_wav_to_audio_frame(io.BytesIO(wav))
+    channels, rate, pcm = parsed
+    frame = pcm_bytes_to_audio_frame(pcm, layout="mono" if channels == 1 else "stereo", rate=rate)
+    if frame.rate == SAMPLE_RATE and frame.layout.name == AUDIO_LAYOUT and frame.format.name == AUDIO_FORMAT:
+        return frame
+    return resample_frame(frame)
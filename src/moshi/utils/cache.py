@@ -0,0 +1,119 @@
+""" This module provides small caches: an in-process LRU bounded by size and an on-disk content-addressed store. """
+import collections
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Hashable
+
+from loguru import logger
+
+from moshi.utils import metrics
+
+logger.success("Loaded!")
+
+
+def digest(*parts) -> str:
+    """Stable hex digest of the parts, for content-addressed keys."""
+    return hashlib.sha256("\0".join(map(str, parts)).encode()).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache, bounded by the total size of its values and optionally by their age.
+    Args:
+        - name: labels the hit/miss counters.
+        - max_size: evict the least recently used entries beyond this total size.
+        - ttl_sec: entries older than this are misses; None to keep them until evicted.
+        - sizeof: size of a value; len() by default, so bytes values are bounded in bytes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size: int,
+        ttl_sec: float | None = None,
+        sizeof: Callable[[Any], int] = len,
+    ):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.size = 0
+        self.__sizeof = sizeof
+        self.__entries: collections.OrderedDict[Hashable, tuple[Any, int, float]] = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = metrics.counter("moshi_cache_hits_total", "Cache lookups that found a value.", cache=name)
+        self.__misses = metrics.counter("moshi_cache_misses_total", "Cache lookups that found nothing.", cache=name)
+        metrics.gauge("moshi_cache_size", "Total size of the values in the cache.", lambda: self.size, cache=name)
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, key: Hashable, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self.__pop(key)
+                entry = None
+            if entry is None:
+                self.__misses.inc()
+                return default
+            self.__entries.move_to_end(key)
+        self.__hits.inc()
+        return entry[0]
+
+    def put(self, key: Hashable, value, ttl_sec: float | None = None):
+        """Store the value; ttl_sec overrides the cache's TTL for this entry. Values larger than the cache are not
+        stored.
+        """
+        size = self.__sizeof(value)
+        if size > self.max_size:
+            logger.debug(f"Not caching value of size {size} > {self.max_size} in {self.name}")
+            return
+        ttl_sec = self.ttl_sec if ttl_sec is None else ttl_sec
+        expires = float("inf") if ttl_sec is None else time.monotonic() + ttl_sec
+        with self.__lock:
+            self.__pop(key)
+            self.__entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                self.__pop(next(iter(self.__entries)))
+
+    def invalidate(self, key: Hashable):
+        with self.__lock:
+            self.__pop(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def __pop(self, key: Hashable):
+        if (entry := self.__entries.pop(key, None)) is not None:
+            self.size -= entry[1]
+
+
+class DiskCache:
+    """Content-addressed store of bytes under a directory, keyed by the digest of the key parts.
+    Writes are atomic so concurrent readers never see partial values. Blocking; call from a thread in async code.
+    """
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def __path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return self.__path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: bytes):
+        path = self.__path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(value)
+        os.replace(tmp, path)
@@ -5,6 +5,7 @@
 
 import asyncio
 import contextvars
+import re
 import textwrap
 from difflib import SequenceMatcher
 
@@ -12,11 +13,19 @@ from google.cloud import translate_v2 as translate
 from loguru import logger
 
 from moshi import Message
+from moshi.utils import metrics
+
+# NOTE the Translate v2 API accepts at most 128 values and recommends at most 30k code points per request.
+TRANSLATE_BATCH_SIZE = 128
+TRANSLATE_BATCH_CHARS = 30000
 
 logger.trace("Loading lang module...")
 client = translate.Client()
 logger.trace("Loaded!")
 
+# terminal punctuation (and any closing quotes or brackets) followed by whitespace; CJK punctuation needs no whitespace.
+SENTENCE_END = re.compile(r"""[.!?…]+["'”’)\]]*\s+|[。！？]+[」』”’)]*\s*|\n+""")
+
 
 def similar(a, b) -> float:
     """Return similarity of two strings.
@@ -26,33 +35,109 @@ def similar(a, b) -> float:
     return SequenceMatcher(None, a, b).ratio()
 
 
+def split_sentences(text: str) -> list[str]:
+    """Split text into sentences on terminal punctuation and line breaks."""
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        sentence = text[start : match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    if tail := text[start:].strip():
+        sentences.append(tail)
+    return sentences
+
+
+class SentenceBuffer:
+    """Accumulates streamed text and releases it a sentence at a time.
+    Sentences keep their trailing whitespace, so joining everything released reproduces the text.
+    """
+
+    def __init__(self):
+        self.__text = ""
+
+    def push(self, text: str) -> list[str]:
+        """Add text; return the sentences it completed."""
+        self.__text += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.__text):
+            if match.end() == len(self.__text):
+                break  # NOTE more punctuation, quotes, or whitespace may be on the way.
+            sentences.append(self.__text[start : match.end()])
+            start = match.end()
+        self.__text = self.__text[start:]
+        return sentences
+
+    def flush(self) -> str:
+        """Release whatever text remains."""
+        text, self.__text = self.__text, ""
+        return text
+
+
 async def translate_messages(messages: list[Message], target: str) -> list[Message]:
-    """ Translate a list of messages. Timeout handled by caller. """
+    """ Translate a list of messages in place, batching them into as few requests as possible. Timeout handled by
+    caller. """
     logger.trace(f"Translating {len(messages)} messages to {target}...")
-    tasks = []
-    async with asyncio.TaskGroup() as tg:  # NOTE if 1 fails (w/ non-cancel), all fail.
-        for message in messages:
-            logger.trace(f"Translating message {message} to {target}...")
-            task = tg.create_task(translate_text(message.content, target=target))
-            tasks.append(task)
-    for i, task in enumerate(tasks):
-        logger.trace(f"Task {i} is {task}")
-        val = await task
-        logger.trace(f"Task {i} returned: {val}")
-        messages[i].content = val
-        logger.trace(f"Translated message {i} to {target}: {messages[i]}")
+    translations = await translate_texts([message.content for message in messages], target=target)
+    for message, translation in zip(messages, translations):
+        message.content = translation
     logger.trace(f"Translated {len(messages)} messages to {target}.")
     return messages
 
 
-async def translate_text(text: str, target: str) -> str:
+def _translation_target(target: str) -> str:
     if '-' in target:
         target = target.split('-')[0]
     assert len(target) in {2, 3}, f"Invalid target language: {target}"
+    return target
+
+
+def _batch_texts(texts: list[str]) -> list[list[str]]:
+    """Split texts into consecutive batches within the per-request limits."""
+    batches = [[]]
+    chars = 0
+    for text in texts:
+        batch = batches[-1]
+        if batch and (len(batch) == TRANSLATE_BATCH_SIZE or chars + len(text) > TRANSLATE_BATCH_CHARS):
+            batch = []
+            batches.append(batch)
+            chars = 0
+        batch.append(text)
+        chars += len(text)
+    return batches if texts else []
+
+
+async def translate_texts(texts: list[str], target: str) -> list[str]:
+    """Translate many texts with one request per batch, sending the batches concurrently. Results are in the order of
+    the texts."""
+    target = _translation_target(target)
+    batches = _batch_texts(texts)
+    logger.trace(f"Translating {len(texts)} texts to {target} in {len(batches)} requests...")
+
+    async def _translate(values: list[str]) -> list[dict]:
+        with metrics.track_api("google_translate"):
+            return await asyncio.to_thread(client.translate, values=values, target_language=target)
+
+    try:
+        async with asyncio.TaskGroup() as tg:  # NOTE if 1 fails (w/ non-cancel), all fail.
+            tasks = [tg.create_task(_translate(batch)) for batch in batches]
+    except* Exception as eg:
+        logger.error(f"Error translating texts: {eg.exceptions}")
+        raise eg.exceptions[0]
+    results = [result for task in tasks for result in task.result()]
+    assert len(results) == len(texts), f"Got {len(results)} translations for {len(texts)} texts"
+    return [result["translatedText"] for result in results]
+
+
+async def translate_text(text: str, target: str) -> str:
+    target = _translation_target(target)
     logger.trace(f"target = {target}")
     logger.trace(f"text = {text}")
     try:
-        result = await asyncio.to_thread(client.translate, values=text, target_language=target)
+        with metrics.track_api("google_translate"):
+            result = await asyncio.to_thread(client.translate, values=text, target_language=target)
     except Exception as e:
         logger.error(f"Error translating text: {e}")
         raise
@@ -66,10 +151,11 @@ async def detect_language(text: str) -> str:
     """
     logger.debug(f"Detecting language for: {textwrap.shorten(text, 64)}")
     # NOTE using to_thread rather than TranslationAsyncClient because later has much more complicated syntax
-    result = await asyncio.to_thread(
-        client.detect_language,
-        text,
-    )
+    with metrics.track_api("google_detect_language"):
+        result = await asyncio.to_thread(
+            client.detect_language,
+            text,
+        )
     conf = result["confidence"]
     lang = result["language"]
     logger.debug(f"Confidence: {conf}")
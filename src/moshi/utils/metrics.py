@@ -0,0 +1,227 @@
+""" This module provides in-process metrics: counters, gauges, latency histograms, per-turn stage timing, and their
+Prometheus text exposition.
+"""
+import asyncio
+import bisect
+import contextlib
+import os
+import resource
+import threading
+import time
+from typing import Callable
+
+from loguru import logger
+
+LATENCY_BUCKETS_SEC = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0)
+LOOP_LAG_BUCKETS_SEC = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+LOOP_LAG_INTERVAL_SEC = 0.5
+
+logger.success("Loaded!")
+
+
+class Histogram:
+    """Cumulative histogram of observations, with the bucket semantics of a Prometheus histogram."""
+
+    def __init__(self, name: str, help: str = "", buckets: tuple[float] = LATENCY_BUCKETS_SEC, **labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # NOTE last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket containing the q-th quantile; inf if it's beyond the last bucket."""
+        with self.__lock:
+            target = q * self.count
+            seen = 0
+            for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+                seen += n
+                if seen >= target and seen > 0:
+                    return bound
+        return float("inf")
+
+
+class Counter:
+    """Monotonically increasing count."""
+
+    def __init__(self, name: str, help: str = "", **labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self.__lock:
+            self.value += amount
+
+
+class Gauge:
+    """Value read from a callback whenever the metrics are rendered."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float], **labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+
+    @property
+    def value(self) -> float:
+        return self.fn()
+
+
+_histograms: dict[tuple[str, tuple], Histogram] = {}
+_counters: dict[tuple[str, tuple], Counter] = {}
+_gauges: dict[tuple[str, tuple], Gauge] = {}
+_lock = threading.Lock()
+
+
+def histogram(name: str, help: str = "", buckets: tuple[float] = LATENCY_BUCKETS_SEC, **labels) -> Histogram:
+    """Get or create the histogram with this name and these labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram(name, help, buckets, **labels)
+        return _histograms[key]
+
+
+def histograms() -> list[Histogram]:
+    with _lock:
+        return list(_histograms.values())
+
+
+def counter(name: str, help: str = "", **labels) -> Counter:
+    """Get or create the counter with this name and these labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if key not in _counters:
+            _counters[key] = Counter(name, help, **labels)
+        return _counters[key]
+
+
+def gauge(name: str, help: str, fn: Callable[[], float], **labels) -> Gauge:
+    """Register (or replace) the gauge with this name and these labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _gauges[key] = Gauge(name, help, fn, **labels)
+        return _gauges[key]
+
+
+@contextlib.contextmanager
+def track_api(api: str):
+    """Time a call to an external API and count its errors and timeouts."""
+    t0 = time.monotonic()
+    try:
+        yield
+    except (asyncio.TimeoutError, TimeoutError):
+        counter("moshi_external_api_errors_total", "Failed calls to external APIs.", api=api, kind="timeout").inc()
+        raise
+    except Exception:
+        counter("moshi_external_api_errors_total", "Failed calls to external APIs.", api=api, kind="error").inc()
+        raise
+    histogram("moshi_external_api_seconds", "Duration of successful calls to external APIs.", api=api).observe(
+        time.monotonic() - t0
+    )
+
+
+def get_rss_bytes() -> int:
+    """Resident set size of this process; falls back to the peak RSS where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL_SEC):
+    """Measure how late the event loop wakes this task up, forever."""
+    hist = histogram(
+        "moshi_event_loop_lag_seconds", "How late the event loop runs a scheduled wakeup.", LOOP_LAG_BUCKETS_SEC
+    )
+    lag = 0.0
+    gauge("moshi_event_loop_lag_last_seconds", "Most recent event loop lag measurement.", lambda: lag)
+    while True:
+        t0 = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - t0 - interval)
+        hist.observe(lag)
+
+
+def _fmt_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text exposition format."""
+    gauge("process_resident_memory_bytes", "Resident memory size in bytes.", get_rss_bytes)
+    with _lock:
+        metrics = [("counter", m) for m in _counters.values()]
+        metrics += [("gauge", m) for m in _gauges.values()]
+        metrics += [("histogram", m) for m in _histograms.values()]
+    lines = []
+    described = set()
+    for kind, m in sorted(metrics, key=lambda km: km[1].name):
+        if m.name not in described:
+            described.add(m.name)
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {kind}")
+        if kind == "histogram":
+            cumulative = 0
+            for bound, n in zip(m.buckets + (float("inf"),), m.counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{m.name}_bucket{_fmt_labels(m.labels, le=le)} {cumulative}")
+            lines.append(f"{m.name}_sum{_fmt_labels(m.labels)} {m.sum}")
+            lines.append(f"{m.name}_count{_fmt_labels(m.labels)} {m.count}")
+        else:
+            lines.append(f"{m.name}{_fmt_labels(m.labels)} {m.value}")
+    return "\n".join(lines) + "\n"
+
+
+class TurnTimer:
+    """Times the stages of one conversational turn, starting from the end of the user's utterance.
+    Each recorded stage is also observed in the moshi_turn_stage_seconds histogram.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages: dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float):
+        logger.debug(f"Turn stage {stage}: {seconds:.3f} sec")
+        self.stages[stage] = seconds
+        histogram(
+            "moshi_turn_stage_seconds", "Duration of each stage of a conversational turn.", stage=stage
+        ).observe(seconds)
+
+    def mark(self, stage: str):
+        """Record the time since the start of the turn."""
+        self.record(stage, time.monotonic() - self.start)
+
+    def since(self, mark: str) -> float:
+        """Seconds elapsed since a stage recorded with mark()."""
+        return time.monotonic() - self.start - self.stages[mark]
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        """Record the duration of the block, if it completes."""
+        t0 = time.monotonic()
+        yield
+        self.record(stage, time.monotonic() - t0)
@@ -1,38 +1,115 @@
 import asyncio
 import os
 import textwrap
-import tempfile
+import time
+from typing import AsyncIterable, AsyncIterator, Iterable
 
-import openai
 from av import AudioFrame
 from google.cloud import texttospeech
 from google.cloud.texttospeech import Voice
 from loguru import logger
 
 from . import audio
-from moshi.utils import secrets
+from moshi.utils import cache, metrics, transcription
 
 GOOGLE_SPEECH_SYNTHESIS_TIMEOUT = int(os.getenv("GOOGLE_SPEECH_SYNTHESIS_TIMEOUT", 5))
 logger.info(f"Using speech synth timeout: {GOOGLE_SPEECH_SYNTHESIS_TIMEOUT}")
 GOOGLE_VOICE_SELECTION_TIMEOUT = int(os.getenv("GOOGLE_VOICE_SELECTION_TIMEOUT", 5))
 logger.info(f"Using language detection timeout: {GOOGLE_VOICE_SELECTION_TIMEOUT}")
-OPENAI_TRANSCRIPTION_MODEL = os.getenv("OPENAI_TRANSCRIPTION_MODEL", "whisper-1")
-logger.info(f"Using transcription model: {OPENAI_TRANSCRIPTION_MODEL}")
+GOOGLE_SPEECH_SYNTHESIS_CONCURRENCY = int(os.getenv("GOOGLE_SPEECH_SYNTHESIS_CONCURRENCY", 3))
+logger.info(f"Using speech synth concurrency: {GOOGLE_SPEECH_SYNTHESIS_CONCURRENCY}")
+VOICE_CATALOG_TTL_SEC = float(os.getenv("MOSHIVOICECATALOGTTLSEC", 24 * 3600))
+logger.info(f"Using voice catalog TTL: {VOICE_CATALOG_TTL_SEC} sec")
+TTS_CACHE_BYTES = int(os.getenv("MOSHITTSCACHEBYTES", 64 * 2**20))  # 0 to disable
+logger.info(f"Using in-process speech synthesis cache size: {TTS_CACHE_BYTES} bytes")
+TTS_CACHE_DIR = os.getenv("MOSHITTSCACHEDIR")  # unset to disable
+logger.info(f"Using on-disk speech synthesis cache: {TTS_CACHE_DIR}")
 
 client = texttospeech.TextToSpeechClient()
+tts_cache = cache.LRUCache("tts", TTS_CACHE_BYTES)
+tts_disk_cache = cache.DiskCache(TTS_CACHE_DIR) if TTS_CACHE_DIR else None
 
 logger.success("Loaded!")
 
-def gender_match(g1: str, g2: 'SsmlVoiceGender') -> bool:
-    if g1.lower() == "female" and g2 == 2:
-        return True
-    elif g1.lower() == "male" and g2 == 1:
-        return True
-    else:
-        return False
 
+class VoiceCatalog:
+    """All available voices, indexed by (language, gender, model class).
+    Languages are indexed both by full code (e.g. "en-us") and base language (e.g. "en"), case-insensitively. The model
+    class is the third part of the voice name, e.g. "Standard" in "en-US-Standard-A". The voice list is fetched once
+    and refetched in the background when older than ttl_sec; if a refetch fails, the stale list is kept.
+    """
+
+    GENDERS = {"male": 1, "female": 2, "neutral": 3}  # NOTE values of texttospeech.SsmlVoiceGender
+
+    def __init__(self, ttl_sec: float = VOICE_CATALOG_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self.__index: dict[tuple[str, int, str], list[Voice]] | None = None
+        self.__loaded_at = 0.0
+        self.__lock = asyncio.Lock()
+        self.__refresh_task = None
+
+    @property
+    def stale(self) -> bool:
+        return self.__index is None or time.monotonic() - self.__loaded_at > self.ttl_sec
 
-async def get_voice(langcode: str, gender="FEMALE", model="Standard") -> str:
+    async def load(self):
+        """Fetch the voice list and rebuild the index.
+        Raises:
+            - asyncio.TimeoutError if timeout exceeded.
+        """
+        with metrics.track_api("google_list_voices"):
+            response = await asyncio.wait_for(
+                asyncio.to_thread(client.list_voices), timeout=GOOGLE_VOICE_SELECTION_TIMEOUT
+            )
+        index = {}
+        for voice in response.voices:
+            parts = voice.name.split("-")
+            if len(parts) < 4:
+                logger.trace(f"Skipping voice with unrecognized name: {voice.name}")
+                continue
+            langs = {lc.lower() for lc in voice.language_codes}
+            langs |= {lc.split("-")[0] for lc in langs}
+            for lang in langs:
+                index.setdefault((lang, int(voice.ssml_gender), parts[2]), []).append(voice)
+        self.__index = index
+        self.__loaded_at = time.monotonic()
+        logger.info(f"Loaded voice catalog: {len(response.voices)} voices, {len(index)} index entries")
+
+    async def refresh(self):
+        """Reload the catalog if it's stale."""
+        async with self.__lock:
+            if not self.stale:
+                return
+            try:
+                await self.load()
+            except Exception as e:
+                if self.__index is None:
+                    logger.error(e)
+                    raise
+                logger.warning(f"Failed to refresh voice catalog, keeping stale catalog: {e}")
+                self.__loaded_at = time.monotonic()  # NOTE back off for a TTL before retrying
+
+    async def get(self, langcode: str, gender="FEMALE", model="Standard") -> Voice:
+        """Get the first voice matching the language, gender, and model class.
+        Raises:
+            - ValueError if no voice found.
+        """
+        if self.__index is None:
+            await self.refresh()
+        elif self.stale and not self.__lock.locked():
+            self.__refresh_task = asyncio.create_task(self.refresh(), name="Refresh voice catalog")
+        key = (langcode.replace("_", "-").lower(), self.GENDERS.get(gender.lower()), model)
+        if voices := self.__index.get(key):
+            return voices[0]
+        raise ValueError(
+            f"Voice not found for langcode={langcode}, gender={gender}, model={model}"
+        )
+
+
+voice_catalog = VoiceCatalog()
+
+
+async def get_voice(langcode: str, gender="FEMALE", model="Standard") -> Voice:
     """Get a valid voice for the language. Just picks the first match.
     Args:
         - langcode: e.g. "en-US"
@@ -43,24 +120,9 @@ async def get_voice(langcode: str, gender="FEMALE", model="Standard") -> str:
         - https://cloud.google.com/text-to-speech/pricing for list of valid voice model classes
     """
     logger.trace(f"Getting voice for lang code: {langcode}")
-    try:
-        response = await asyncio.wait_for(
-            asyncio.to_thread(client.list_voices, language_code=langcode),
-            timeout=GOOGLE_VOICE_SELECTION_TIMEOUT,
-        )
-    except Exception as e:
-        logger.error(e)
-        raise
-    voices = response.voices
-    logger.trace(f"Language {langcode} has {len(voices)} supported voices.")
-    for voice in voices:
-        logger.trace(f"Checking voice: {voice}")
-        if model in voice.name and gender_match(gender, voice.ssml_gender):
-            logger.trace("Found match")
-            return voice
-    raise ValueError(
-        f"Voice not found for langcode={langcode}, gender={gender}, model={model}"
-    )
+    voice = await voice_catalog.get(langcode, gender, model)
+    logger.trace(f"Found voice: {voice.name}")
+    return voice
 
 
 async def _synthesize_speech_bytes(text: str, voice: Voice, rate: int = 24000) -> bytes:
@@ -87,36 +149,100 @@ async def _synthesize_speech_bytes(text: str, voice: Voice, rate: int = 24000) -
         voice=voice_selector,
         audio_config=audio_config,
     )
-    response = await asyncio.wait_for(
-        asyncio.to_thread(
-            client.synthesize_speech,
-            request=request,
-        ),
-        timeout=GOOGLE_SPEECH_SYNTHESIS_TIMEOUT,
-    )
+    with metrics.track_api("google_synthesize_speech"):
+        response = await asyncio.wait_for(
+            asyncio.to_thread(
+                client.synthesize_speech,
+                request=request,
+            ),
+            timeout=GOOGLE_SPEECH_SYNTHESIS_TIMEOUT,
+        )
     logger.debug(
         f"Got response from texttospeech.synthesize_speech: {textwrap.shorten(str(response.audio_content), 32)}"
     )
     return response.audio_content
 
 
+def _tts_cache_key(text: str, voice: Voice, rate: int) -> str:
+    text = " ".join(text.split())
+    return cache.digest(text, voice.name, voice.language_codes[0], rate)
+
+
 async def synthesize(text: str, voice: Voice, rate: int = 24000) -> AudioFrame:
+    """Synthesize speech to a frame in the pipeline format.
+    Synthesized PCM is cached in process and, if TTS_CACHE_DIR is set, on disk. A fresh frame is built on every call
+    because callers set its pts.
+    """
+    key = _tts_cache_key(text, voice, rate)
+    pcm = tts_cache.get(key)
+    if pcm is None and tts_disk_cache is not None:
+        if (pcm := await asyncio.to_thread(tts_disk_cache.get, key)) is not None:
+            tts_cache.put(key, pcm)
+    if pcm is not None:
+        logger.debug(f"Speech synthesis cache hit: {textwrap.shorten(text, 32)}")
+        return audio.pcm_bytes_to_audio_frame(pcm)
     audio_bytes = await _synthesize_speech_bytes(text, voice, rate)
     assert isinstance(audio_bytes, bytes)
     audio_frame = audio.wav_bytes_to_audio_frame(audio_bytes)
     assert isinstance(audio_frame, AudioFrame)
+    pcm = audio.frame_pcm(audio_frame).tobytes()
+    tts_cache.put(key, pcm)
+    if tts_disk_cache is not None:
+        try:
+            await asyncio.to_thread(tts_disk_cache.put, key, pcm)
+        except OSError as e:
+            logger.warning(f"Failed to write speech synthesis cache: {e}")
     return audio_frame
 
 
-async def transcribe(audio_frame: AudioFrame, language: str = None) -> str:
-    await secrets.login_openai()
-    _, fp = tempfile.mkstemp(suffix=".wav")
+async def synthesize_stream(
+    sentences: Iterable[str] | AsyncIterable[str], voice: Voice, rate: int = 24000
+) -> AsyncIterator[AudioFrame]:
+    """Synthesize sentences concurrently, yielding their audio in order as soon as each is ready.
+    At most GOOGLE_SPEECH_SYNTHESIS_CONCURRENCY sentences are synthesized ahead of the one being yielded. Closing the
+    generator cancels any synthesis still in flight.
+    """
+    tasks = asyncio.Queue()
+    slots = asyncio.Semaphore(GOOGLE_SPEECH_SYNTHESIS_CONCURRENCY)  # NOTE released once a sentence's audio is taken.
+    running = set()
+
+    async def _start(sentence: str):
+        await slots.acquire()
+        task = asyncio.create_task(synthesize(sentence, voice, rate))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        tasks.put_nowait(task)
+
+    async def _schedule():
+        try:
+            if isinstance(sentences, AsyncIterable):
+                async for sentence in sentences:
+                    await _start(sentence)
+            else:
+                for sentence in sentences:
+                    await _start(sentence)
+        except Exception as e:
+            tasks.put_nowait(e)
+        else:
+            tasks.put_nowait(None)
+
+    scheduler = asyncio.create_task(_schedule(), name="Schedule speech synthesis")
     try:
-        audio.write_audio_frame_to_wav(audio_frame, fp)
-        with open(fp, "rb") as f:
-            transcript = await openai.Audio.atranscribe(
-                OPENAI_TRANSCRIPTION_MODEL, f, language=language
-            )
+        while (task := await tasks.get()) is not None:
+            if isinstance(task, Exception):
+                raise task
+            frame = await task
+            slots.release()
+            yield frame
     finally:
-        os.remove(fp)
-    return transcript["text"]
+        scheduler.cancel()
+        for task in running:
+            task.cancel()
+        await asyncio.gather(scheduler, *running, return_exceptions=True)
+
+
+async def transcribe(audio_frame: AudioFrame, language: str = None, prompt: str = None) -> str:
+    """Transcribe the audio with the language's transcription backend. The prompt, e.g. the transcript of the preceding
+    audio, helps continuity.
+    """
+    return await transcription.transcribe(audio_frame, language=language, prompt=prompt)
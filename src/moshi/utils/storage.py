@@ -1,16 +1,36 @@
+import datetime
+import os
+
 from google.cloud import firestore
 from loguru import logger
 
 from moshi import GOOGLE_PROJECT
 from moshi.core.base import Profile
+from moshi.utils import cache
+
+USAGE_CACHE_TTL_SEC = float(os.getenv("MOSHIUSAGECACHETTLSEC", 30))
+logger.info(f"Using daily usage cache TTL: {USAGE_CACHE_TTL_SEC} sec")
+PROFILE_CACHE_TTL_SEC = float(os.getenv("MOSHIPROFILECACHETTLSEC", 60))
+logger.info(f"Using profile cache TTL: {PROFILE_CACHE_TTL_SEC} sec")
+PROFILE_WATCH = bool(int(os.getenv("MOSHIPROFILEWATCH", 0)))
+logger.info(f"Using profile snapshot listener: {PROFILE_WATCH}")
 
 logger.debug("Creating Firestore client...")
 firestore_client = firestore.AsyncClient(project=GOOGLE_PROJECT)
 logger.info(f"Firestore client initialized.")
+usage_col = firestore_client.collection("usage")
+usage_cache = cache.LRUCache("daily_usage", 4096, ttl_sec=USAGE_CACHE_TTL_SEC, sizeof=lambda _: 1)
+profile_cache = cache.LRUCache("profiles", 4096, ttl_sec=PROFILE_CACHE_TTL_SEC, sizeof=lambda _: 1)
+profile_watch = None
 
 
 async def get_profile(uid: str) -> Profile:
-    """Get the user profile."""
+    """Get the user profile, cached for PROFILE_CACHE_TTL_SEC or until invalidated.
+    Raises:
+        - ValueError if the user has no profile.
+    """
+    if (profile := profile_cache.get(uid)) is not None:
+        return profile
     collection_ref = firestore_client.collection("profiles")
     doc_ref = collection_ref.document(uid)
     doc = await doc_ref.get()
@@ -18,4 +38,64 @@ async def get_profile(uid: str) -> Profile:
         raise ValueError(f"User profile not found: {uid}")
     profile = Profile(**doc.to_dict(), uid=uid)
     logger.trace(f"User profile: {profile}")
+    profile_cache.put(uid, profile)
     return profile
+
+
+def invalidate_profile(uid: str):
+    """Drop the cached profile, e.g. after updating it."""
+    profile_cache.invalidate(uid)
+
+
+def _on_profiles_snapshot(snapshots, changes, read_time):
+    """Invalidate profiles as they change. Called from the listener's thread."""
+    for change in changes:
+        if change.type.name != "ADDED":  # NOTE the initial snapshot adds every profile
+            logger.trace(f"Profile {change.type.name.lower()}: {change.document.id}")
+            invalidate_profile(change.document.id)
+
+
+def start_profile_watch():
+    """Listen for changes to profiles so cached profiles are invalidated as soon as they change.
+    NOTE uses the sync client, as only it supports snapshot listeners.
+    """
+    global profile_watch
+    if profile_watch is not None:
+        return
+    client = firestore.Client(project=GOOGLE_PROJECT)
+    profile_watch = client.collection("profiles").on_snapshot(_on_profiles_snapshot)
+    logger.info("Watching profiles for changes.")
+
+
+def stop_profile_watch():
+    global profile_watch
+    if profile_watch is not None:
+        profile_watch.unsubscribe()
+        profile_watch = None
+
+
+def _usage_key(uid: str) -> tuple[str, str]:
+    return uid, datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+
+async def get_daily_convo_count(uid: str) -> int:
+    """Number of conversations the user has started today (UTC), from their daily usage counter doc.
+    Cached for USAGE_CACHE_TTL_SEC; this process's own increments are applied to the cache directly.
+    """
+    key = _usage_key(uid)
+    if (count := usage_cache.get(key)) is not None:
+        return count
+    doc = await usage_col.document("_".join(key)).get()
+    count = doc.to_dict().get("conversations", 0) if doc.exists else 0
+    usage_cache.put(key, count)
+    return count
+
+
+async def increment_daily_convo_count(uid: str):
+    """Count a new conversation in the user's daily usage counter doc, without reading it."""
+    key = _usage_key(uid)
+    await usage_col.document("_".join(key)).set(
+        {"uid": uid, "date": key[1], "conversations": firestore.Increment(1)}, merge=True
+    )
+    if (count := usage_cache.get(key)) is not None:
+        usage_cache.put(key, count + 1)
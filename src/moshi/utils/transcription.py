@@ -0,0 +1,222 @@
+""" This module provides the speech-to-text backends: the OpenAI API, and a faster-whisper model run locally on CPU.
+The backend is selected per deployment and, optionally, per language.
+"""
+import asyncio
+import io
+import multiprocessing
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import openai
+from av import AudioFrame
+from loguru import logger
+
+from . import audio
+from moshi.utils import metrics, secrets
+
+OPENAI_TRANSCRIPTION_MODEL = os.getenv("OPENAI_TRANSCRIPTION_MODEL", "whisper-1")
+logger.info(f"Using transcription model: {OPENAI_TRANSCRIPTION_MODEL}")
+OPENAI_TRANSCRIPTION_ENCODING = os.getenv("OPENAI_TRANSCRIPTION_ENCODING", "wav")  # wav, flac, or opus
+assert OPENAI_TRANSCRIPTION_ENCODING in audio.ENCODINGS, f"Unsupported encoding: {OPENAI_TRANSCRIPTION_ENCODING}"
+OPENAI_TRANSCRIPTION_SAMPLE_RATE = int(os.getenv("OPENAI_TRANSCRIPTION_SAMPLE_RATE", 16000))
+logger.info(
+    f"Using transcription upload encoding: {OPENAI_TRANSCRIPTION_ENCODING} at {OPENAI_TRANSCRIPTION_SAMPLE_RATE} Hz mono"
+)
+TRANSCRIPTION_FILE_EXTENSIONS = {"wav": "wav", "flac": "flac", "opus": "ogg"}
+TRANSCRIPTION_BACKEND = os.getenv("MOSHITRANSCRIPTIONBACKEND", "openai")  # "openai" or "local"
+TRANSCRIPTION_BACKEND_LANGS = os.getenv("MOSHITRANSCRIPTIONBACKENDLANGS", "")  # overrides per language, e.g. "en=local,ja=openai"
+logger.info(f"Using transcription backend: {TRANSCRIPTION_BACKEND}, per language: {TRANSCRIPTION_BACKEND_LANGS}")
+LOCAL_TRANSCRIPTION_MODEL = os.getenv("MOSHILOCALTRANSCRIPTIONMODEL", "base")  # faster-whisper model size or path.
+LOCAL_TRANSCRIPTION_WORKERS = int(os.getenv("MOSHILOCALTRANSCRIPTIONWORKERS", 1))  # processes, each with a model.
+LOCAL_TRANSCRIPTION_THREADS = int(os.getenv("MOSHILOCALTRANSCRIPTIONTHREADS", 2))  # CPU threads per model.
+LOCAL_TRANSCRIPTION_SAMPLE_RATE = 16000  # NOTE whisper models take 16 kHz mono.
+WHISPER_LANGUAGES = {"cmn": "zh", "yue": "zh", "fil": "tl", "nb": "no", "iw": "he"}  # Google's codes Whisper names otherwise.
+logger.info(
+    f"Using local transcription model: {LOCAL_TRANSCRIPTION_MODEL}, "
+    f"workers: {LOCAL_TRANSCRIPTION_WORKERS}, threads: {LOCAL_TRANSCRIPTION_THREADS}"
+)
+
+logger.success("Loaded!")
+
+
+def whisper_language(language: str | None) -> str | None:
+    """Whisper's code for the base language of a language code, e.g. "cmn-CN" -> "zh"."""
+    if not language:
+        return None
+    language = language.split("-")[0].lower()
+    return WHISPER_LANGUAGES.get(language, language)
+
+
+class TranscriptionBackend(ABC):
+    """Transcribes utterances to text."""
+
+    @abstractmethod
+    async def transcribe(self, audio_frame: AudioFrame, language: str = None, prompt: str = None) -> str:
+        """Transcribe the audio. The language is an ISO-639-1 code, e.g. "en"; the prompt, e.g. the transcript of the
+        preceding audio, helps continuity.
+        """
+
+    async def warm(self):
+        """Load whatever the backend needs, so the first transcription doesn't wait for it."""
+
+    def shutdown(self):
+        """Release the backend's resources."""
+
+
+class OpenAIBackend(TranscriptionBackend):
+    """Uploads the audio to the OpenAI transcription API."""
+
+    async def transcribe(self, audio_frame: AudioFrame, language: str = None, prompt: str = None) -> str:
+        await secrets.login_openai()
+        encoded = await asyncio.to_thread(
+            audio.encode_audio_frame,
+            audio_frame,
+            encoding=OPENAI_TRANSCRIPTION_ENCODING,
+            rate=OPENAI_TRANSCRIPTION_SAMPLE_RATE,
+        )
+        logger.debug(f"Uploading {len(encoded)} bytes of {OPENAI_TRANSCRIPTION_ENCODING} for transcription")
+        f = io.BytesIO(encoded)
+        ext = TRANSCRIPTION_FILE_EXTENSIONS[OPENAI_TRANSCRIPTION_ENCODING]
+        f.name = f"utterance.{ext}"  # NOTE openai infers the upload format from the file name.
+        with metrics.track_api("openai_transcribe"):
+            transcript = await openai.Audio.atranscribe(
+                OPENAI_TRANSCRIPTION_MODEL,
+                f,
+                language=whisper_language(language),
+                **({"prompt": prompt} if prompt else {}),
+            )
+        return transcript["text"]
+
+
+_model = None  # the worker process's faster-whisper model
+
+
+def _load_model(model: str, threads: int):
+    """Initialize a worker process with its model."""
+    global _model
+    from faster_whisper import WhisperModel
+
+    _model = WhisperModel(model, device="cpu", compute_type="int8", cpu_threads=threads)
+
+
+def _ready() -> int:
+    """A worker that runs this has loaded its model."""
+    return os.getpid()
+
+
+def _transcribe_pcm(pcm: np.ndarray, language: str | None, prompt: str | None) -> str:
+    """Transcribe 16 kHz mono s16 PCM in the worker process. Unsupported languages are detected by the model."""
+    if language is not None and language not in _model.supported_languages:
+        logger.warning(f"Language not supported by the local transcription model, detecting it: {language}")
+        language = None
+    segments, _ = _model.transcribe(
+        pcm.astype(np.float32) / 32768.0, language=language, initial_prompt=prompt, vad_filter=False
+    )
+    return "".join(segment.text for segment in segments).strip()
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """Runs a faster-whisper (CTranslate2) model on CPU in a pool of worker processes, so transcription needs no
+    upload and doesn't block the event loop. Requires the optional dependency: pip install moshi[local-stt].
+    The pool, and the model in each worker, are loaded by warm() or on first use. Workers are spawned, not forked, so
+    they don't inherit the server's gRPC and event loop threads.
+    """
+
+    def __init__(
+        self,
+        model: str = LOCAL_TRANSCRIPTION_MODEL,
+        workers: int = LOCAL_TRANSCRIPTION_WORKERS,
+        threads: int = LOCAL_TRANSCRIPTION_THREADS,
+    ):
+        try:
+            import faster_whisper  # noqa: F401
+        except ImportError as e:
+            raise ImportError("The local transcription backend requires: pip install moshi[local-stt]") from e
+        self.model = model
+        self.workers = workers
+        self.threads = threads
+        self.__pool = None
+
+    def __get_pool(self) -> ProcessPoolExecutor:
+        if self.__pool is None:
+            logger.info(f"Starting {self.workers} local transcription workers with model: {self.model}")
+            self.__pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_model,
+                initargs=(self.model, self.threads),
+            )
+        return self.__pool
+
+    async def warm(self):
+        loop = asyncio.get_running_loop()
+        pool = self.__get_pool()
+        pids = await asyncio.gather(*(loop.run_in_executor(pool, _ready) for _ in range(self.workers)))
+        logger.info(f"Local transcription workers ready: {sorted(set(pids))}")
+
+    async def transcribe(self, audio_frame: AudioFrame, language: str = None, prompt: str = None) -> str:
+        frame = await asyncio.to_thread(
+            audio.resample_frame, audio_frame, format="s16", layout="mono", rate=LOCAL_TRANSCRIPTION_SAMPLE_RATE
+        )
+        pcm = frame.to_ndarray().reshape(-1)
+        loop = asyncio.get_running_loop()
+        with metrics.track_api("local_transcribe"):
+            return await loop.run_in_executor(
+                self.__get_pool(), _transcribe_pcm, pcm, whisper_language(language), prompt
+            )
+
+    def shutdown(self):
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+            self.__pool = None
+
+
+BACKENDS = {"openai": OpenAIBackend, "local": LocalWhisperBackend}
+assert TRANSCRIPTION_BACKEND in BACKENDS, f"Unsupported transcription backend: {TRANSCRIPTION_BACKEND}"
+
+
+def _parse_backend_langs(spec: str) -> dict[str, str]:
+    """Parse "en=local,ja=openai" into {"en": "local", "ja": "openai"}."""
+    langs = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        lang, _, name = item.partition("=")
+        name = name.strip()
+        if name not in BACKENDS:
+            raise ValueError(f"Unsupported transcription backend for {lang}: {name}, expected one of {list(BACKENDS)}")
+        langs[lang.strip().lower()] = name
+    return langs
+
+
+backend_langs = _parse_backend_langs(TRANSCRIPTION_BACKEND_LANGS)
+backends: dict[str, TranscriptionBackend] = {}
+
+
+def get_backend(language: str = None) -> TranscriptionBackend:
+    """The backend for the language, falling back to the deployment's TRANSCRIPTION_BACKEND. Backends are created on
+    first use and shared.
+    """
+    name = backend_langs.get((language or "").lower(), TRANSCRIPTION_BACKEND)
+    if name not in backends:
+        backends[name] = BACKENDS[name]()
+    return backends[name]
+
+
+async def transcribe(audio_frame: AudioFrame, language: str = None, prompt: str = None) -> str:
+    return await get_backend(language).transcribe(audio_frame, language=language, prompt=prompt)
+
+
+async def warm():
+    """Create and warm the backends configured for the deployment and for each language."""
+    names = {TRANSCRIPTION_BACKEND, *backend_langs.values()}
+    for name in names:
+        if name not in backends:
+            backends[name] = BACKENDS[name]()
+    await asyncio.gather(*(backends[name].warm() for name in names))
+
+
+def shutdown():
+    for backend in backends.values():
+        backend.shutdown()
+    backends.clear()
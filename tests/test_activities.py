@@ -1,9 +1,11 @@
 import asyncio
+from unittest import mock
+
 import pytest
 
 from google.cloud import texttospeech
 
-from moshi.core.base import User, Profile, Message
+from moshi.core.base import User, Profile, Message, Role
 from moshi.utils import ctx, storage
 from moshi.core import activities
 
@@ -27,7 +29,7 @@ def user():
 
 @pytest.fixture(autouse=True)
 def profile():
-    profile = Profile(name="testname", lang="en", uid="testuid")
+    profile = Profile(name="testname", lang="en", uid="testuid", primary_lang="en")
     tok = ctx.profile.set(profile)
     try:
         yield
@@ -53,3 +55,95 @@ def test_new_conversation(event_loop, activity_type):
     assert transcript.uid == ctx.user.get().uid
     # NOTE this fails because the messages are not the same object (transcript is still dict, needs to be parsed by Message)
     # assert transcript.messages == act.messages
+
+
+@pytest.mark.asyncio
+async def test_get_translated_prompt():
+    """A prompt is translated once per language, then served from the cache as fresh messages."""
+    async def dummy_translate(messages, target):
+        for msg in messages:
+            msg.content = f"{target}:{msg.content}"
+        return messages
+
+    prompt = activities.Unstructured()._prompt()
+    original = prompt[0].content
+    doc = mock.Mock(get=mock.AsyncMock(return_value=mock.Mock(exists=False)), set=mock.AsyncMock())
+    col = mock.Mock(document=mock.Mock(return_value=doc))
+    translate = mock.AsyncMock(side_effect=dummy_translate)
+    with mock.patch.object(activities, "translated_prompt_col", col), mock.patch.object(
+        activities, "translated_prompts", {}
+    ), mock.patch.object(activities.lang, "translate_messages", translate):
+        first = await activities.get_translated_prompt(activities.ActivityType.UNSTRUCTURED, prompt, "es")
+        second = await activities.get_translated_prompt(
+            activities.ActivityType.UNSTRUCTURED, activities.Unstructured()._prompt(), "es"
+        )
+    assert translate.await_count == 1
+    assert doc.set.await_count == 1
+    assert first == second and first is not second
+    assert first[0] is not second[0]
+    assert first[0].content == f"es:{original}"
+
+
+@pytest.fixture
+def transcript_doc():
+    """Mock Firestore transcript document recording the number of messages in each write."""
+    writes = []
+
+    async def dummy_set(data):
+        await asyncio.sleep(0.01)
+        writes.append(len(data["messages"]))
+
+    doc = mock.Mock(id="testcid", set=mock.AsyncMock(side_effect=dummy_set))
+    col = mock.Mock(document=mock.Mock(return_value=doc))
+    voice = mock.Mock(language_codes=["en-US"])
+    with mock.patch.object(activities, "transcript_col", col), mock.patch.object(
+        activities, "get_translated_prompt", mock.AsyncMock(side_effect=lambda t, p, l: p)
+    ), mock.patch.object(activities.speech, "get_voice", mock.AsyncMock(return_value=voice)), mock.patch.object(
+        storage, "increment_daily_convo_count", mock.AsyncMock()
+    ):
+        yield writes
+
+
+@pytest.mark.asyncio
+async def test_transcript_write_behind(transcript_doc):
+    """Messages added in quick succession are coalesced into one write, and stop() flushes the rest."""
+    with mock.patch.object(activities, "TRANSCRIPT_DEBOUNCE_SEC", 0.05):
+        act = activities.Unstructured()
+        await act.start()
+        prompt_len = len(act.messages)
+        assert transcript_doc == [prompt_len]
+        act.add_msg(Message(Role.USR, "hello"))
+        act.add_msg(Message(Role.AST, "hi"))
+        await asyncio.sleep(0.1)
+        assert transcript_doc == [prompt_len, prompt_len + 2]
+        act.add_msg(Message(Role.USR, "bye"))
+        await act.stop()
+    assert transcript_doc == [prompt_len, prompt_len + 2, prompt_len + 3]
+    assert not act.dirty
+
+
+@pytest.mark.asyncio
+async def test_transcript_append_storage(transcript_doc):
+    """In append mode the header is written once and each message once."""
+    batches = []
+
+    def dummy_batch():
+        writes = []
+        commit = mock.AsyncMock(side_effect=lambda: batches.append(writes))
+        return mock.Mock(set=lambda ref, data: writes.append(data), commit=commit)
+
+    with mock.patch.object(activities, "TRANSCRIPT_STORAGE", "append"), mock.patch.object(
+        activities, "TRANSCRIPT_DEBOUNCE_SEC", 0
+    ), mock.patch.object(activities.firestore_client, "batch", dummy_batch):
+        act = activities.Unstructured()
+        await act.start()
+        prompt_len = len(act.messages)
+        act.add_msg(Message(Role.USR, "hello"))
+        act.add_msg(Message(Role.USR, "hello"))
+        await act.stop()
+    assert transcript_doc == []  # NOTE no whole-document writes
+    assert len(batches) == 2
+    assert batches[0][0]["activity_type"] == activities.ActivityType.UNSTRUCTURED
+    assert "messages" not in batches[0][0]
+    assert len(batches[0]) == 1 + prompt_len
+    assert batches[1] == [{"role": Role.USR, "content": "hello"}] * 2
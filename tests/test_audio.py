@@ -1,6 +1,7 @@
 import io
 import tempfile
 
+import numpy as np
 import pytest
 from av import AudioFifo, AudioFrame
 
@@ -31,3 +32,118 @@ def test_audio_frame_to_wav(short_audio_frame):
     audio.write_audio_frame_to_wav(short_audio_frame, fp)
     loaded_frame = audio.load_wav_to_buffer(fp).read()
     assert (short_audio_frame.to_ndarray() == loaded_frame.to_ndarray()).all()
+
+
+def test_ring_buffer_wraps():
+    rate, window = 1000, 10
+    ring = audio.PCMRingBuffer(capacity_sec=0.05, window=window, channels=1, rate=rate)
+    for i in range(12):
+        frame = audio.empty_frame(length=7, layout="mono", rate=rate)
+        audio.frame_pcm(frame)[:] = i
+        ring.write(frame)
+    assert ring.written == 84
+    assert ring.oldest == 84 - ring.capacity
+    frame = ring.read(ring.written - 14, ring.written)
+    assert (frame.to_ndarray() == [10] * 7 + [11] * 7).all()
+    with pytest.raises(ValueError):
+        ring.read(0, 10)
+
+
+def test_ring_buffer_grows():
+    """The ring starts small and grows as it fills, keeping what was written, up to its capacity."""
+    rate, window = 1000, 10
+    ring = audio.PCMRingBuffer(capacity_sec=0.1, window=window, channels=1, rate=rate, initial_sec=0.02)
+    for i in range(20):
+        frame = audio.empty_frame(length=7, layout="mono", rate=rate)
+        audio.frame_pcm(frame)[:] = i
+        ring.write(frame)
+        start = max(ring.oldest, ring.written - 70)
+        expected = np.repeat(np.arange(20), 7)[start : ring.written]
+        assert (ring.read(start, ring.written).to_ndarray().reshape(-1) == expected).all()
+    assert ring.oldest == 140 - ring.capacity
+
+
+def test_ring_buffer_analyze():
+    rate, window = 8000, 160
+    ring = audio.PCMRingBuffer(capacity_sec=1.0, window=window, channels=2, rate=rate)
+    t = np.arange(window * 3) / rate
+    tone = (1000 * np.sin(2 * np.pi * 400 * t)).astype(np.int16)
+    frame = audio.empty_frame(length=window * 3, layout="stereo", rate=rate)
+    audio.frame_pcm(frame)[:] = np.repeat(tone, 2)
+    ring.write(frame)
+    rms, zcr = ring.analyze()
+    assert len(rms) == 3
+    assert np.allclose(rms, 1000 / np.sqrt(2), rtol=0.01)
+    assert np.allclose(zcr, 2 * 400 / rate, atol=0.01)
+    assert audio.get_frame_energy(ring.read(0, window)) == pytest.approx(rms[0], rel=1e-3)
+    rms, zcr = ring.analyze()
+    assert len(rms) == 0
+
+
+def _tone_frame(segments: list[tuple[int, float]], rate: int = 8000) -> "AudioFrame":
+    """A mono frame of 400 Hz tone segments with the given (amplitude, seconds)."""
+    arrs = []
+    for amp, sec in segments:
+        t = np.arange(int(sec * rate)) / rate
+        arrs.append((amp * np.sin(2 * np.pi * 400 * t)).astype(np.int16))
+    frame = AudioFrame.from_ndarray(np.concatenate(arrs).reshape(1, -1), format="s16", layout="mono")
+    frame.rate = rate
+    return frame
+
+
+def test_trim_silence():
+    frame = _tone_frame([(0, 1.0), (5000, 0.5), (0, 2.0), (5000, 0.5), (0, 1.0)])
+    trimmed = audio.trim_silence(frame)
+    expected_sec = 0.5 + 2.0 + 0.5 + 2 * audio.TRIM_PAD_SEC
+    assert audio.get_frame_seconds(trimmed) == pytest.approx(expected_sec, abs=0.05)
+    compressed = audio.trim_silence(frame, max_pause_sec=0.5, keep_pause_sec=0.2)
+    expected_sec = 0.5 + 0.2 + 0.5 + 2 * audio.TRIM_PAD_SEC
+    assert audio.get_frame_seconds(compressed) == pytest.approx(expected_sec, abs=0.05)
+
+
+def test_trim_silence_no_speech():
+    frame = _tone_frame([(0, 1.0)])
+    assert audio.trim_silence(frame) is None
+
+
+def test_wav_bytes_roundtrip(short_audio_frame):
+    wav = audio.audio_frame_to_wav_bytes(short_audio_frame)
+    decoded = audio.load_wav_to_buffer(io.BytesIO(wav)).read()
+    assert (short_audio_frame.to_ndarray() == decoded.to_ndarray()).all()
+    frame = audio.wav_bytes_to_audio_frame(wav)
+    assert frame.rate == audio.SAMPLE_RATE
+    assert frame.layout.name == audio.AUDIO_LAYOUT
+    assert (short_audio_frame.to_ndarray() == frame.to_ndarray()).all()
+
+
+def test_wav_bytes_to_audio_frame_resamples():
+    buf = io.BytesIO()
+    frame = audio.empty_frame(length=2400, layout="mono", rate=24000)
+    audio.frame_pcm(frame)[:] = 1000
+    audio.write_audio_frame_to_wav(frame, buf)
+    decoded = audio.wav_bytes_to_audio_frame(buf.getvalue())
+    assert decoded.rate == audio.SAMPLE_RATE
+    assert decoded.layout.name == audio.AUDIO_LAYOUT
+    assert abs(audio.get_frame_seconds(decoded) - 0.1) < 0.005
+
+
+@pytest.mark.parametrize("encoding", ["wav", "flac", "opus"])
+def test_encode_audio_frame(short_audio_frame, encoding):
+    encoded = audio.encode_audio_frame(short_audio_frame, encoding=encoding, rate=16000)
+    assert len(encoded) < len(audio.audio_frame_to_wav_bytes(short_audio_frame)) / 5
+    decoded = audio.load_wav_to_buffer(io.BytesIO(encoded)).read()
+    assert len(decoded.layout.channels) == 1
+    assert abs(audio.get_frame_seconds(decoded) - audio.get_frame_seconds(short_audio_frame)) < 0.05
+
+
+def test_resample_frame_reuses_resampler():
+    frame = audio.empty_frame(length=2400, layout="mono", rate=24000)
+    audio.frame_pcm(frame)[:] = 1000
+    outs = [audio.resample_frame(frame) for _ in range(3)]
+    key = ("s16", "mono", 24000, audio.AUDIO_FORMAT, audio.AUDIO_LAYOUT, audio.SAMPLE_RATE)
+    assert len(audio._resamplers[key]) == 1
+    for out in outs:
+        assert out.rate == audio.SAMPLE_RATE
+        arr = out.to_ndarray()[0]
+        assert (arr != 0).sum() >= 2 * 4800 - 8, "the whole frame is resampled every time"
+        assert arr.shape[0] <= 2 * (4800 + audio.SAMPLE_RATE * audio.RESAMPLER_PAD_SEC)
@@ -4,6 +4,8 @@ NOTE: This test requires a test user in the Firebase auth service.
 NOTE: You must set FIREBASE_AUTH_EMULATOR_HOST="127.0.0.1:9099" in your environment.
 """
 import asyncio
+import time
+from unittest import mock
 
 import pytest
 import requests
@@ -38,3 +40,57 @@ async def test_api_auth(auth_token):
     response = client.get("/version", headers={"Authorization": f"Bearer {auth_token}"})
     print(response.json())
     assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_verify_id_token_cached():
+    """A verified token isn't verified again until it expires."""
+    verify = mock.Mock(side_effect=[{"uid": "u1", "exp": time.time() + 60}, {"uid": "u2", "exp": time.time() - 1}])
+    with mock.patch.object(auth.fauth, "verify_id_token", verify):
+        assert (await auth.verify_id_token("token1"))["uid"] == "u1"
+        assert (await auth.verify_id_token("token1"))["uid"] == "u1"
+        await auth.verify_id_token("expired")
+    assert verify.call_count == 2
+    assert auth.id_token_cache.get(auth.cache.digest("expired")) is None
+
+
+@pytest.mark.asyncio
+async def test_get_custom_claims_cached():
+    get_user = mock.Mock(return_value=mock.Mock(custom_claims=None))
+    with mock.patch.object(auth.fauth, "get_user", get_user):
+        assert await auth.get_custom_claims("noclaims") == {}
+        assert await auth.get_custom_claims("noclaims") == {}
+    assert get_user.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_authorize_concurrent():
+    """Claims, usage, and profile lookups overlap; the limit and profile checks raise HTTP errors."""
+    entered = {"claims": asyncio.Event(), "count": asyncio.Event(), "profile": asyncio.Event()}
+
+    async def lookup(name, value):
+        """Return only once every lookup has been entered, so they must overlap."""
+        entered[name].set()
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in entered.values())), 1.0)
+        return value
+
+    profile = mock.Mock()
+    decoded_token = {"uid": "u1", "email": "test@test.test"}
+    with (
+        mock.patch.object(
+            auth, "get_custom_claims", mock.Mock(side_effect=lambda uid: lookup("claims", {"daily_convo_limit": 2}))
+        ),
+        mock.patch.object(auth.storage, "get_daily_convo_count", mock.Mock(side_effect=lambda uid: lookup("count", 1))),
+        mock.patch.object(auth.storage, "get_profile", mock.Mock(side_effect=lambda uid: lookup("profile", profile))),
+    ):
+        user, prof = await auth.authorize(decoded_token)
+        assert user.daily_convo_limit == 2 and prof is profile
+        auth.storage.get_daily_convo_count.side_effect = lambda uid: lookup("count", 2)
+        with pytest.raises(HTTPException) as e:
+            await auth.authorize(decoded_token)
+        assert e.value.status_code == 429
+        auth.storage.get_daily_convo_count.side_effect = lambda uid: lookup("count", 0)
+        auth.storage.get_profile.side_effect = ValueError
+        with pytest.raises(HTTPException) as e:
+            await auth.authorize(decoded_token)
+        assert e.value.status_code == 400
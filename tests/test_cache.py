@@ -0,0 +1,36 @@
+import time
+
+from moshi.utils import cache
+
+
+def test_lru_cache_evicts_by_size():
+    lru = cache.LRUCache("test_evict", max_size=10)
+    lru.put("a", b"12345")
+    lru.put("b", b"12345")
+    assert lru.get("a") == b"12345"  # NOTE "b" is now least recently used
+    lru.put("c", b"123")
+    assert lru.get("b") is None
+    assert lru.get("a") == b"12345"
+    assert lru.size == 8
+    lru.put("big", b"x" * 11)
+    assert lru.get("big") is None
+    assert len(lru) == 2
+
+
+def test_lru_cache_ttl():
+    lru = cache.LRUCache("test_ttl", max_size=10, ttl_sec=0.01)
+    lru.put("a", b"1")
+    lru.put("b", b"1", ttl_sec=60)
+    assert lru.get("a") == b"1"
+    time.sleep(0.02)
+    assert lru.get("a") is None
+    assert lru.get("b") == b"1"
+    assert lru.size == 1
+
+
+def test_disk_cache(tmp_path):
+    disk = cache.DiskCache(tmp_path)
+    key = cache.digest("hello", "en-US-Standard-A", 24000)
+    assert disk.get(key) is None
+    disk.put(key, b"pcm")
+    assert cache.DiskCache(tmp_path).get(key) == b"pcm"
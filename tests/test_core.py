@@ -97,14 +97,11 @@ async def test_chatter_aiortc_components(
     assert chatter.messages[-2] == Message(Role.USR, DUMMY_USR_TEXT)
     assert chatter.messages[-1] == Message(Role.AST, DUMMY_AST_TEXT)
     # Check convolution of utterance with the sink
-    res = audio.make_resampler()
-    _ut = res.resample(utframe)
-    assert len(_ut) == 1
-    _ut = _ut[0]
+    _ut = audio.resample_frame(utframe)
     _sk = sink.fifo.read()
-    assert _sk.format.name == res.format.name
-    assert _sk.layout.name == res.layout.name
-    assert _sk.rate == res.rate
+    assert _sk.format.name == audio.AUDIO_FORMAT
+    assert _sk.layout.name == audio.AUDIO_LAYOUT
+    assert _sk.rate == audio.SAMPLE_RATE
     ut = _ut.to_ndarray()
     sk = _sk.to_ndarray()
     print("convolving sk by ut...")
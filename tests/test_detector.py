@@ -0,0 +1,140 @@
+import asyncio
+from unittest import mock
+
+import numpy as np
+import pytest
+from aiortc import MediaStreamTrack
+from av import AudioFrame
+
+from moshi import AUDIO_FORMAT, AUDIO_LAYOUT, SAMPLE_RATE, audio
+from moshi.call import detector
+
+FRAME_SEC = 0.02
+FRAME_SAMPLES = int(SAMPLE_RATE * FRAME_SEC)
+
+
+def _frame(amplitude: int) -> AudioFrame:
+    """A packed stereo frame of a 440 Hz tone (or silence if amplitude is 0)."""
+    t = np.arange(FRAME_SAMPLES) / SAMPLE_RATE
+    tone = (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    arr = np.repeat(tone, 2).reshape(1, -1)
+    frame = AudioFrame.from_ndarray(arr, format=AUDIO_FORMAT, layout=AUDIO_LAYOUT)
+    frame.rate = SAMPLE_RATE
+    return frame
+
+
+class ScriptedTrack(MediaStreamTrack):
+    """Plays (amplitude, seconds) segments as fast as they're read, then silence."""
+
+    kind = "audio"
+
+    def __init__(self, segments: list[tuple[int, float]]):
+        super().__init__()
+        self.__amplitudes = [
+            amp for amp, sec in segments for _ in range(round(sec / FRAME_SEC))
+        ]
+        self.__pts = 0
+
+    async def recv(self) -> AudioFrame:
+        await asyncio.sleep(0)
+        amp = self.__amplitudes.pop(0) if self.__amplitudes else 0
+        frame = _frame(amp)
+        frame.pts = self.__pts
+        self.__pts += frame.samples
+        return frame
+
+
+def test_vad_onset_and_hangover():
+    vad = detector.EnergyVAD(speech_ratio=3.0, silence_ratio=1.5, hangover_sec=0.1, onset_sec=0.04)
+    for _ in range(10):
+        assert not vad.update(50.0, FRAME_SEC)
+    assert not vad.update(1000.0, FRAME_SEC), "onset requires onset_sec of speech"
+    assert vad.update(1000.0, FRAME_SEC)
+    for _ in range(4):
+        assert vad.update(50.0, FRAME_SEC), "hangover keeps the utterance open"
+    assert not vad.update(50.0, FRAME_SEC)
+
+
+def test_vad_onset_near_threshold():
+    """Speech just over the speech ratio starts an utterance however long the onset is; the floor holds meanwhile."""
+    vad = detector.EnergyVAD(speech_ratio=3.0, onset_sec=0.2)
+    for _ in range(10):
+        vad.update(50.0, FRAME_SEC)
+    for _ in range(9):
+        assert not vad.update(3.5 * 50.0, FRAME_SEC)
+    assert vad.noise_floor == 50.0
+    assert vad.update(3.5 * 50.0, FRAME_SEC)
+
+
+def test_vad_noise_floor_adapts():
+    vad = detector.EnergyVAD()
+    vad.update(10.0, FRAME_SEC)
+    assert vad.noise_floor == audio.MIN_NOISE_FLOOR
+    for _ in range(200):
+        vad.update(80.0, FRAME_SEC)
+    assert not vad.speaking, "a slowly rising background is not speech"
+    assert vad.noise_floor > 70.0
+    vad.update(40.0, FRAME_SEC)
+    assert vad.noise_floor == 40.0, "the noise floor drops immediately"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["vad", "ring"])
+async def test_get_utterance_vad(mode):
+    track = ScriptedTrack([(0, 0.5), (8000, 1.0), (0, 2.0)])
+    det = detector.UtteranceDetector(mode=mode)
+    det.setTrack(track)
+    frame = await det.get_utterance()
+    utt_sec = audio.get_frame_seconds(frame)
+    expected_sec = 1.0 + detector.VAD_PREROLL_SEC + detector.VAD_HANGOVER_SEC
+    assert expected_sec - 0.1 <= utt_sec <= expected_sec + 0.1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["vad", "ring"])
+@mock.patch("moshi.call.detector.UTT_START_TIMEOUT_SEC", 0.2)
+async def test_get_utterance_vad_not_started(silent_audio_track, mode):
+    det = detector.UtteranceDetector(mode=mode)
+    det.setTrack(silent_audio_track)
+    with pytest.raises(detector.UtteranceNotStartedError):
+        await det.get_utterance()
+
+
+@pytest.mark.asyncio
+async def test_wait_speech_onset():
+    """A blip shorter than BARGE_IN_ONSET_SEC is ignored; the next utterance continues from the onset."""
+    track = ScriptedTrack([(0, 0.5), (8000, 0.1), (0, 0.5), (8000, 1.0), (0, 2.0)])
+    det = detector.UtteranceDetector(mode="vad")
+    det.setTrack(track)
+    await det.wait_speech_onset()
+    frame = await det.get_utterance()
+    utt_sec = audio.get_frame_seconds(frame)
+    # NOTE the preroll ends at the later barge-in onset
+    expected_sec = 1.0 + detector.VAD_PREROLL_SEC + detector.VAD_HANGOVER_SEC - detector.BARGE_IN_ONSET_SEC
+    assert expected_sec - 0.1 <= utt_sec <= expected_sec + 0.1
+    with pytest.raises(ValueError):
+        await detector.UtteranceDetector(mode="ring").wait_speech_onset()
+
+
+@pytest.mark.asyncio
+async def test_wait_speech_onset_moderate_snr():
+    """Speech 5x louder than the background interrupts with the default barge-in onset."""
+    track = ScriptedTrack([(1000, 1.0), (5000, 0.5)] + [(1000, 1.0)] * 5)
+    det = detector.UtteranceDetector(mode="vad")
+    det.setTrack(track)
+    await asyncio.wait_for(det.wait_speech_onset(), 1.0)
+
+
+@pytest.mark.asyncio
+@mock.patch("moshi.call.detector.SEGMENT_MIN_SEC", 1.0)
+async def test_get_utterance_segments():
+    """The utterance is cut into segments at pauses, which together make up the whole utterance."""
+    track = ScriptedTrack([(0, 0.5), (8000, 1.5), (0, 0.4), (8000, 0.4), (0, 0.4), (8000, 1.0), (0, 2.0)])
+    det = detector.UtteranceDetector(mode="vad")
+    det.setTrack(track)
+    segments = []
+    frame = await det.get_utterance(on_segment=segments.append)
+    assert len(segments) == 3, "the short segment is kept with the next, then the rest of the hangover follows"
+    assert audio.get_frame_seconds(segments[-1]) < detector.VAD_HANGOVER_SEC
+    assert sum(segment.samples for segment in segments) == frame.samples
+    assert (np.concatenate([s.to_ndarray() for s in segments], axis=1) == frame.to_ndarray()).all()
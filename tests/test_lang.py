@@ -1,6 +1,9 @@
+from unittest import mock
+
 import pytest
 
-from moshi import lang
+from moshi import Message, Role
+from moshi.utils import lang
 
 
 @pytest.mark.gcloud
@@ -45,3 +48,49 @@ async def test_detect_language(sentence, langcode):
     detlang = await lang.detect_language(sentence)
     print(f"detlang={detlang}")
     assert detlang.startswith(langcode)
+
+
+@pytest.mark.parametrize(
+    "text,sentences",
+    [
+        ("Hello there! How are you?", ["Hello there!", "How are you?"]),
+        ('He said "ok." Then left', ['He said "ok."', "Then left"]),
+        ("3.14 is pi", ["3.14 is pi"]),
+        ("こんにちは。元気ですか？", ["こんにちは。", "元気ですか？"]),
+        ("line one\nline two", ["line one", "line two"]),
+        ("", []),
+    ],
+)
+def test_split_sentences(text, sentences):
+    assert lang.split_sentences(text) == sentences
+
+
+def test_sentence_buffer():
+    buffer = lang.SentenceBuffer()
+    assert buffer.push("Hello. How") == ["Hello. "]
+    assert buffer.push(" are you?") == [], "the sentence may not be over yet"
+    assert buffer.push("! Good") == ["How are you?! "]
+    assert buffer.flush() == "Good"
+    assert buffer.flush() == ""
+
+
+def test_batch_texts():
+    texts = ["a" * 10] * 300
+    batches = lang._batch_texts(texts)
+    assert [len(b) for b in batches] == [128, 128, 44]
+    with mock.patch.object(lang, "TRANSLATE_BATCH_CHARS", 25):
+        assert [len(b) for b in lang._batch_texts(texts[:5])] == [2, 2, 1]
+    assert lang._batch_texts([]) == []
+
+
+@pytest.mark.asyncio
+async def test_translate_messages_batched():
+    """All messages go out in one request and come back in order."""
+    def dummy_translate(values, target_language):
+        return [{"translatedText": f"{target_language}:{v}"} for v in values]
+
+    messages = [Message(Role.SYS, "one"), Message(Role.USR, "two"), Message(Role.AST, "three")]
+    with mock.patch.object(lang.client, "translate", mock.Mock(side_effect=dummy_translate)) as translate:
+        messages = await lang.translate_messages(messages, "es-MX")
+    assert translate.call_count == 1
+    assert [m.content for m in messages] == ["es:one", "es:two", "es:three"]
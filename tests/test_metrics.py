@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from moshi.utils import metrics
+
+
+def test_histogram():
+    hist = metrics.Histogram("test_seconds", buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1]
+    assert hist.count == 4
+    assert hist.sum == pytest.approx(2.65)
+    assert hist.quantile(0.5) == 0.1
+    assert hist.quantile(0.75) == 1.0
+    assert hist.quantile(1.0) == float("inf")
+
+
+def test_turn_timer():
+    turn = metrics.TurnTimer()
+    with turn.stage("transcription"):
+        pass
+    turn.mark("first_audio")
+    turn.record("utterance", 1.5)
+    assert set(turn.stages) == {"transcription", "first_audio", "utterance"}
+    assert turn.since("first_audio") >= 0.0
+    hist = metrics.histogram("moshi_turn_stage_seconds", stage="utterance")
+    assert hist.count >= 1
+
+
+def test_track_api_counts_errors():
+    errors = metrics.counter("moshi_external_api_errors_total", api="test_api", kind="timeout")
+    before = errors.value
+    with pytest.raises(asyncio.TimeoutError):
+        with metrics.track_api("test_api"):
+            raise asyncio.TimeoutError()
+    assert errors.value == before + 1
+    with metrics.track_api("test_api"):
+        pass
+    assert metrics.histogram("moshi_external_api_seconds", api="test_api").count >= 1
+
+
+async def test_monitor_event_loop_lag():
+    task = asyncio.create_task(metrics.monitor_event_loop_lag(interval=0.01))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert metrics.histogram("moshi_event_loop_lag_seconds").count >= 1
+
+
+def test_render():
+    metrics.counter("test_render_total", "A test counter.", kind='a "quoted" value').inc(3)
+    metrics.gauge("test_render_gauge", "A test gauge.", lambda: 7)
+    metrics.histogram("test_render_seconds", "A test histogram.", (0.5,)).observe(1.0)
+    text = metrics.render()
+    assert "# TYPE test_render_total counter" in text
+    assert 'test_render_total{kind="a \\"quoted\\" value"} 3' in text
+    assert "test_render_gauge 7" in text
+    assert 'test_render_seconds_bucket{le="0.5"} 0' in text
+    assert 'test_render_seconds_bucket{le="+Inf"} 1' in text
+    assert "test_render_seconds_count 1" in text
+    assert metrics.get_rss_bytes() > 0
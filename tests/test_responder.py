@@ -1,11 +1,13 @@
 import asyncio
+import time
 
 import av
 import pytest
 from aiortc.mediastreams import MediaStreamError
 from av import AudioFifo, AudioFrame
 
-from moshi import audio, responder
+from moshi import audio
+from moshi.call import responder
 
 
 @pytest.mark.asyncio
@@ -14,25 +16,25 @@ async def test_responder_track(short_audio_frame, Sink):
     contains the expected audio data.
     This test exercises the ResponsePlayerStream, it does not exercise the ResponsePlayer.
     """
-    empty_seconds = 1.5  # let the ResponsePlayerStream play <empty_seconds> of silence
+    empty_seconds = 1.5  # the ResponsePlayerStream only plays its silence tail while idle
     audible_seconds = audio.get_frame_seconds(short_audio_frame)
-    total_expected_sec = empty_seconds + audible_seconds
-    sent = asyncio.Event()
-    track = responder.ResponsePlayerStream(sent)
+    tail_seconds = responder.SILENCE_TAIL_SEC
+    total_expected_sec = 2 * tail_seconds + audible_seconds
+    track = responder.ResponsePlayerStream()
     sink = Sink(track)
     await sink.start()
-    await asyncio.sleep(
-        empty_seconds
-    )  # ResponsePlayerStream should write empty_seconds of silence
+    await asyncio.sleep(empty_seconds)
     track.write_audio(short_audio_frame)
     frame_time = audio.get_frame_seconds(short_audio_frame)
     timeout = frame_time + 1.0
-    await asyncio.wait_for(sent.wait(), timeout)
+    await asyncio.wait_for(track.wait_sent(), timeout)
+    await asyncio.sleep(tail_seconds + 0.1)
     await sink.stop()
     frame = sink.fifo.read()
     frame_time = audio.get_frame_seconds(frame)
-    # the extra on top of total_expected_sec accounts for the default 100ms playback throttle plus some compute time
-    assert total_expected_sec <= frame_time <= total_expected_sec + 0.2
+    # NOTE the partial frame at the end of the audio is padded with silence
+    frame_sec = responder.FRAME_SIZE / audio.SAMPLE_RATE
+    assert total_expected_sec <= frame_time <= total_expected_sec + frame_sec
     arr = frame.to_ndarray()
     proportion_speech = (arr != 0).sum() / arr.shape[1]
     expected_proportion_speech = audible_seconds / total_expected_sec
@@ -45,14 +47,14 @@ async def test_responder_track(short_audio_frame, Sink):
 
 @pytest.mark.asyncio
 async def test_responder_track_pts(short_audio_frame):
-    sent = asyncio.Event()
-    track = responder.ResponsePlayerStream(sent)
+    track = responder.ResponsePlayerStream()
     frames = []
     pts = 0
     for i in range(5):
         frame = await track.recv()
         print(f"got frame: {frame}")
         assert frame.pts == pts, "pts not incrementing correctly"
+        assert audio.get_frame_energy(frame) == 0.0, "audible frame before writing"
         frames.append(frame)
         pts += frame.samples
     track.write_audio(short_audio_frame)
@@ -66,17 +68,101 @@ async def test_responder_track_pts(short_audio_frame):
 
 
 @pytest.mark.asyncio
-async def test_responder(short_audio_frame, Sink, status_fn):
-    """Check that the ResponsePlayer writes audio to the Sink when it receives the audio and silence while it waits."""
-    empty_seconds = 1.0
+async def test_responder_track_paced(short_audio_frame):
+    """Frames are released on the media clock, at most BUFFER_AHEAD_SEC ahead; the track blocks when idle."""
+    track = responder.ResponsePlayerStream()
+    for _ in range(round(responder.SILENCE_TAIL_SEC * audio.SAMPLE_RATE / responder.FRAME_SIZE)):
+        await track.recv()
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(track.recv(), 0.1)
+    track.write_audio(short_audio_frame)
+    t0 = time.monotonic()
+    n_frames = short_audio_frame.samples // responder.FRAME_SIZE
+    for _ in range(n_frames):
+        await track.recv()
+    elapsed = time.monotonic() - t0
+    expected = n_frames * responder.FRAME_SIZE / audio.SAMPLE_RATE - responder.BUFFER_AHEAD_SEC
+    assert expected - 0.05 <= elapsed <= expected + 0.1
+    track.stop()
+    with pytest.raises(MediaStreamError):
+        for _ in range(100):
+            await track.recv()
+
+
+@pytest.mark.asyncio
+async def test_responder(short_audio_frame, Sink):
+    """Check that the ResponsePlayer writes audio to the Sink when it receives the audio."""
     audible_seconds = audio.get_frame_seconds(short_audio_frame)
-    total_seconds = empty_seconds + audible_seconds
-    player = responder.ResponsePlayer(status_fn)
+    player = responder.ResponsePlayer()
     sink = Sink(player.audio)
     await sink.start()  # starts pulling silence (and audio when available) from player stream
-    await asyncio.sleep(empty_seconds)
+    await asyncio.sleep(1.0)
+    t0 = time.monotonic()
     await player.send_utterance(short_audio_frame)
+    elapsed = time.monotonic() - t0
     await sink.stop()
     frame = sink.fifo.read()
     frame_time = audio.get_frame_seconds(frame)
-    assert total_seconds <= frame_time <= total_seconds + 0.2
+    assert audible_seconds - responder.BUFFER_AHEAD_SEC - 0.05 <= elapsed <= audible_seconds
+    frame_sec = responder.FRAME_SIZE / audio.SAMPLE_RATE
+    assert audible_seconds <= frame_time <= audible_seconds + responder.SILENCE_TAIL_SEC + frame_sec
+
+
+def test_buffer_backend(short_audio_frame):
+    """The buffer backend reads the same audio as the fifo backend, into reused frames."""
+    buffered = responder.BufferBackend(pool_size=2)
+    fifo = responder.FifoBackend()
+    for _ in range(3):  # NOTE more than the initial capacity, so the buffer grows
+        buffered.write(short_audio_frame)
+        fifo.write(short_audio_frame)
+    seen = []
+    while (expected := fifo.read(responder.FRAME_SIZE)) is not None:
+        frame = buffered.read(responder.FRAME_SIZE)
+        assert (frame.to_ndarray() == expected.to_ndarray()).all()
+        seen.append(frame)
+    assert buffered.read(responder.FRAME_SIZE) is None
+    assert len({id(frame) for frame in seen}) == 2
+    buffered.clear()
+    buffered.write(short_audio_frame)
+    assert buffered.read(responder.FRAME_SIZE) is not None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["buffer", "fifo"])
+async def test_responder_track_backends(short_audio_frame, backend):
+    track = responder.ResponsePlayerStream(backend=backend)
+    track.write_audio(short_audio_frame)
+    frame = await track.recv()
+    assert audio.get_frame_energy(frame) > 0.0
+    assert frame.pts == 0
+
+
+@pytest.mark.asyncio
+async def test_responder_flush(short_audio_frame):
+    """Flushing drops the unplayed audio; only the silence tail follows."""
+    track = responder.ResponsePlayerStream()
+    track.write_audio(short_audio_frame)
+    assert audio.get_frame_energy(await track.recv()) > 0.0
+    track.flush()
+    await asyncio.wait_for(track.wait_sent(), 0.1)
+    assert audio.get_frame_energy(await track.recv()) == 0.0
+    assert track.played_samples == responder.FRAME_SIZE, "flushed audio and silence aren't played"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["buffer", "fifo"])
+async def test_responder_partial_frame(backend):
+    """The tail of written audio shorter than a frame is padded with silence and played, not dropped."""
+    track = responder.ResponsePlayerStream(backend=backend)
+    tail = 100
+    frame = audio.empty_frame(responder.FRAME_SIZE + tail)
+    audio.frame_pcm(frame)[:] = 1000
+    track.write_audio(frame)
+    assert audio.get_frame_energy(await track.recv()) > 0.0
+    padded = (await track.recv()).to_ndarray().reshape(-1)
+    channels = len(frame.layout.channels)
+    assert (padded[: tail * channels] == 1000).all()
+    assert (padded[tail * channels :] == 0).all()
+    assert track.played_samples == 2 * responder.FRAME_SIZE
+    assert audio.get_frame_energy(await track.recv()) == 0.0
+    await asyncio.wait_for(track.wait_sent(), 0.1)
@@ -1,11 +1,13 @@
 """ Test that the speech module produces synthesized language in av.AudioFrame format. """
 import asyncio
 import tempfile
+from types import SimpleNamespace
+from unittest import mock
 
 import pytest
 from av import AudioFrame
 
-from moshi import audio, gcloud, lang, speech
+from moshi.utils import audio, cache, gcloud, lang, speech
 
 
 @pytest.mark.asyncio
@@ -60,3 +62,87 @@ async def test_complementary_synthesis_and_transcription():
     print(f"transcript={transcript}")
     print(f"text={text}")
     assert lang.similar(transcript, text) > 0.75
+
+
+@pytest.mark.asyncio
+async def test_synthesize_stream_order():
+    """Sentences are synthesized concurrently but yielded in order."""
+    started = []
+
+    async def dummy_synthesize(text, voice, rate=24000):
+        started.append(text)
+        await asyncio.sleep(0.01 * (3 - len(text)))  # earlier sentences finish last
+        frame = audio.empty_frame(length=len(text))
+        return frame
+
+    with mock.patch("moshi.utils.speech.synthesize", dummy_synthesize):
+        frames = [f async for f in speech.synthesize_stream(["a", "bb", "ccc"], voice=None)]
+    assert [f.samples for f in frames] == [1, 2, 3]
+    assert started == ["a", "bb", "ccc"]
+
+
+@pytest.mark.asyncio
+async def test_synthesize_stream_close():
+    """Closing the stream while it's full cancels every synthesis it started; no more than the concurrency limit run."""
+    running = set()
+    peak = 0
+
+    async def dummy_synthesize(text, voice, rate=24000):
+        nonlocal peak
+        running.add(text)
+        peak = max(peak, len(running))
+        try:
+            if text != "0":
+                await asyncio.Event().wait()  # NOTE never finishes
+            return audio.empty_frame(length=1)
+        finally:
+            running.discard(text)
+
+    with mock.patch("moshi.utils.speech.synthesize", dummy_synthesize):
+        frames = speech.synthesize_stream([str(i) for i in range(10)], voice=None)
+        await anext(frames)
+        await asyncio.sleep(0.01)  # NOTE let the scheduler fill up
+        assert len(running) == speech.GOOGLE_SPEECH_SYNTHESIS_CONCURRENCY
+        await frames.aclose()
+    assert not running
+    assert peak == speech.GOOGLE_SPEECH_SYNTHESIS_CONCURRENCY
+
+
+@pytest.mark.asyncio
+async def test_synthesize_cache(tmp_path):
+    """Repeated text is synthesized once; each call gets its own frame."""
+    voice = SimpleNamespace(name="en-US-Standard-A", language_codes=["en-US"])
+    wav = audio.audio_frame_to_wav_bytes(audio.empty_frame(length=480, layout="mono", rate=24000))
+    synth = mock.AsyncMock(return_value=wav)
+    with mock.patch("moshi.utils.speech._synthesize_speech_bytes", synth), mock.patch(
+        "moshi.utils.speech.tts_disk_cache", cache.DiskCache(tmp_path)
+    ):
+        first = await speech.synthesize("Hello  there.", voice)
+        speech.tts_cache.clear()  # NOTE falls back to the disk cache
+        second = await speech.synthesize("Hello there. ", voice)
+        third = await speech.synthesize("Hello there.", voice)
+    assert synth.await_count == 1
+    assert first is not second and second is not third
+    assert second.samples == first.samples == third.samples
+    assert second.rate == audio.SAMPLE_RATE
+
+
+@pytest.mark.asyncio
+async def test_voice_catalog():
+    """Voices are listed once and looked up by language, gender, and model class."""
+    voices = [
+        SimpleNamespace(name="en-US-Wavenet-A", language_codes=["en-US"], ssml_gender=2),
+        SimpleNamespace(name="en-US-Standard-B", language_codes=["en-US"], ssml_gender=1),
+        SimpleNamespace(name="en-GB-Standard-C", language_codes=["en-GB"], ssml_gender=2),
+        SimpleNamespace(name="ja-JP-Standard-A", language_codes=["ja-JP"], ssml_gender=2),
+    ]
+    list_voices = mock.Mock(return_value=SimpleNamespace(voices=voices))
+    catalog = speech.VoiceCatalog()
+    with mock.patch.object(speech.client, "list_voices", list_voices):
+        assert (await catalog.get("en_US", "MALE")).name == "en-US-Standard-B"
+        assert (await catalog.get("en", "FEMALE")).name == "en-GB-Standard-C"
+        assert (await catalog.get("ja", "FEMALE")).name == "ja-JP-Standard-A"
+        assert (await catalog.get("en-US", "FEMALE", "Wavenet")).name == "en-US-Wavenet-A"
+        with pytest.raises(ValueError):
+            await catalog.get("ja", "MALE")
+    assert list_voices.call_count == 1
@@ -0,0 +1,42 @@
+from unittest import mock
+
+import pytest
+
+from moshi.utils import storage
+
+
+@pytest.mark.asyncio
+async def test_daily_convo_count():
+    """Counts are read once, then kept current by this process's increments."""
+    doc = mock.Mock(
+        get=mock.AsyncMock(return_value=mock.Mock(exists=True, to_dict=lambda: {"conversations": 3})),
+        set=mock.AsyncMock(),
+    )
+    col = mock.Mock(document=mock.Mock(return_value=doc))
+    with mock.patch.object(storage, "usage_col", col):
+        assert await storage.get_daily_convo_count("counteduid") == 3
+        await storage.increment_daily_convo_count("counteduid")
+        assert await storage.get_daily_convo_count("counteduid") == 4
+    assert doc.get.await_count == 1
+    assert doc.set.await_count == 1
+    assert doc.set.call_args.kwargs == {"merge": True}
+
+
+@pytest.mark.asyncio
+async def test_profile_cache():
+    """Profiles are read once until invalidated, including by the snapshot listener."""
+    data = {"lang": "en-US", "name": "Timmy Test", "primary_lang": "en-US"}
+    doc = mock.Mock(get=mock.AsyncMock(return_value=mock.Mock(exists=True, to_dict=lambda: data)))
+    col = mock.Mock(document=mock.Mock(return_value=doc))
+    with mock.patch.object(storage.firestore_client, "collection", mock.Mock(return_value=col)):
+        assert (await storage.get_profile("cacheduid")).name == "Timmy Test"
+        await storage.get_profile("cacheduid")
+        assert doc.get.await_count == 1
+        storage.invalidate_profile("cacheduid")
+        await storage.get_profile("cacheduid")
+        assert doc.get.await_count == 2
+        change = mock.Mock(document=mock.Mock(id="cacheduid"))
+        change.type.name = "MODIFIED"
+        storage._on_profiles_snapshot([], [change], None)
+        await storage.get_profile("cacheduid")
+        assert doc.get.await_count == 3
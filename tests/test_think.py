@@ -3,7 +3,8 @@ from unittest import mock
 import openai
 import pytest
 
-from moshi import Message, Model, ModelType, Role, think
+from moshi import Message, Model, ModelType, Role
+from moshi.call import think
 
 MODELS = [Model.TEXTADA001, Model.GPT35TURBO0301]
 
@@ -55,3 +56,81 @@ def test_completion_scrub(response, desired):
     print(f"out: {cleaned}")
     print(f"want: {desired}")
     assert cleaned == desired
+
+
+def _chunks(deltas: list[str]):
+    async def _acreate(*a, **k):
+        assert k["stream"]
+
+        async def _gen():
+            for delta in deltas:
+                yield openai.openai_object.OpenAIObject.construct_from(
+                    {"choices": [{"delta": {"content": delta}, "finish_reason": None}]}
+                )
+
+        return _gen()
+
+    return _acreate
+
+
+@pytest.mark.asyncio
+async def test_stream_completion_sentences():
+    deltas = ["Hel", "lo there", "! How", " are you?", " Fine"]
+    with mock.patch("openai.ChatCompletion.acreate", _chunks(deltas)), mock.patch(
+        "moshi.utils.secrets.login_openai", mock.AsyncMock()
+    ):
+        sentences = [
+            s
+            async for s in think.stream_completion_from_assistant(
+                [Message(Role.USR, "hi")], model=Model.GPT35TURBO
+            )
+        ]
+    assert sentences == ["Hello there! ", "How are you? ", "Fine"]
+
+
+def _text_chunks(deltas: list[str], closed: list):
+    async def _acreate(*a, **k):
+        assert k["stream"]
+
+        async def _gen():
+            try:
+                for delta in deltas:
+                    yield openai.openai_object.OpenAIObject.construct_from(
+                        {"choices": [{"text": delta, "finish_reason": None}]}
+                    )
+            finally:
+                closed.append(True)
+
+        return _gen()
+
+    return _acreate
+
+
+@pytest.mark.asyncio
+async def test_stream_completion_role_prefix():
+    """The completion model's role prefix is stripped from the start of the response only."""
+    deltas = ["\n", "2", ": Hel", "lo there! ", "It's 10: 30 now. ", "Bye "]
+    with mock.patch("openai.Completion.acreate", _text_chunks(deltas, [])), mock.patch(
+        "moshi.utils.secrets.login_openai", mock.AsyncMock()
+    ):
+        sentences = [
+            s
+            async for s in think.stream_completion_from_assistant(
+                [Message(Role.USR, "hi")], model=Model.TEXTDAVINCI002
+            )
+        ]
+    assert sentences == ["Hello there! ", "It's 10: 30 now. ", "Bye "]
+
+
+@pytest.mark.asyncio
+async def test_stream_completion_close():
+    """Closing the sentence stream closes the OpenAI stream behind it."""
+    closed = []
+    deltas = ["One. ", "Two. ", "Three. "]
+    with mock.patch("openai.Completion.acreate", _text_chunks(deltas, closed)), mock.patch(
+        "moshi.utils.secrets.login_openai", mock.AsyncMock()
+    ):
+        stream = think.stream_completion_from_assistant([Message(Role.USR, "hi")], model=Model.TEXTDAVINCI002)
+        assert await anext(stream) == "One. "
+        await stream.aclose()
+    assert closed
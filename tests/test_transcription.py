@@ -0,0 +1,72 @@
+""" Test the selection of transcription backends and the local backend. """
+from unittest import mock
+
+import pytest
+
+from moshi.utils import lang, speech, transcription
+
+
+class FakeBackend(transcription.TranscriptionBackend):
+    def __init__(self):
+        self.calls = []
+
+    async def transcribe(self, audio_frame, language=None, prompt=None):
+        self.calls.append((language, prompt))
+        return "test"
+
+
+def test_parse_backend_langs():
+    assert transcription._parse_backend_langs(" en=local, JA = openai ,") == {"en": "local", "ja": "openai"}
+    with pytest.raises(ValueError):
+        transcription._parse_backend_langs("en=nope")
+
+
+@pytest.mark.parametrize(
+    "language,expected", [("en", "en"), ("cmn", "zh"), ("cmn-CN", "zh"), ("JA", "ja"), (None, None)]
+)
+def test_whisper_language(language, expected):
+    assert transcription.whisper_language(language) == expected
+
+
+@pytest.mark.asyncio
+async def test_warm():
+    """The backends configured for the deployment and for each language are created and warmed at startup."""
+    warmed = []
+
+    class WarmBackend(FakeBackend):
+        async def warm(self):
+            warmed.append(self)
+
+    with mock.patch.object(transcription, "backends", {}), mock.patch.object(
+        transcription, "BACKENDS", {"openai": WarmBackend, "local": WarmBackend}
+    ), mock.patch.object(transcription, "backend_langs", {"cmn": "local"}), mock.patch.object(
+        transcription, "TRANSCRIPTION_BACKEND", "openai"
+    ):
+        await transcription.warm()
+        assert set(warmed) == set(transcription.backends.values())
+        assert len(warmed) == 2
+
+
+@pytest.mark.asyncio
+async def test_backend_per_language(short_audio_frame):
+    local, remote = FakeBackend(), FakeBackend()
+    with mock.patch.object(transcription, "backends", {"local": local, "openai": remote}), mock.patch.object(
+        transcription, "backend_langs", {"en": "local"}
+    ), mock.patch.object(transcription, "TRANSCRIPTION_BACKEND", "openai"):
+        assert transcription.get_backend("EN") is local
+        assert await speech.transcribe(short_audio_frame, language="en", prompt="hi") == "test"
+        assert await speech.transcribe(short_audio_frame, language="ja") == "test"
+    assert local.calls == [("en", "hi")]
+    assert remote.calls == [("ja", None)]
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+async def test_local_backend(short_audio_frame):
+    pytest.importorskip("faster_whisper")
+    backend = transcription.LocalWhisperBackend(model="tiny")
+    try:
+        transcript = await backend.transcribe(short_audio_frame, language="en")
+    finally:
+        backend.shutdown()
+    assert lang.similar(transcript, "test") > 0.5
@@ -0,0 +1,107 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from moshi import audio
+from moshi.call import responder, webrtc
+from moshi.core import activities
+from moshi.core.base import Profile, User
+from moshi.utils import ctx, metrics
+
+
+@pytest.mark.asyncio
+async def test_start_awaits_authorization():
+    """The connection can reach "connecting", starting the adapter, before the call's authorization finishes; the
+    activity must still start with the authorized user and profile in context.
+    """
+    user = User(uid="testuid", email="test@test.test")
+    profile = Profile(name="testname", lang="en", uid="testuid", primary_lang="en")
+    authorization = asyncio.get_running_loop().create_future()
+    seen = {}
+
+    async def act_start():
+        seen["user"], seen["profile"] = ctx.user.get(), ctx.profile.get()
+
+    async def noop(*args):
+        pass
+
+    with mock.patch.object(webrtc.WebRTCAdapter, "_WebRTCAdapter__run", noop):
+        adapter = webrtc.WebRTCAdapter(activities.ActivityType.UNSTRUCTURED, authorization=authorization)
+        adapter.act = mock.Mock(start=act_start, cid="testcid")
+        adapter.wait_dc_connected = noop
+        starting = asyncio.create_task(adapter.start())  # NOTE "connecting" fires first
+        await asyncio.sleep(0.01)
+        assert not starting.done() and not seen, "started before authorization"
+        authorization.set_result((user, profile))
+        await asyncio.wait_for(starting, 1.0)
+    assert seen == {"user": user, "profile": profile}
+
+
+@pytest.mark.asyncio
+async def test_start_authorization_fails():
+    authorization = asyncio.get_running_loop().create_future()
+    authorization.set_exception(PermissionError("denied"))
+    adapter = webrtc.WebRTCAdapter(activities.ActivityType.UNSTRUCTURED, authorization=authorization)
+    adapter.act = mock.Mock(start=mock.AsyncMock())
+    with pytest.raises(PermissionError):
+        await adapter.start()
+    adapter.act.start.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_barge_in_keeps_spoken_sentences():
+    """When the user interrupts, only the sentences that began playing are added to the transcript."""
+    ctx.user.set(User(uid="testuid", email="test@test.test"))
+    sentence_sec = 1.5
+
+    async def completion(*args, **kwargs):
+        for sentence in ["One. ", "Two. ", "Three. ", "Four. "]:
+            yield sentence
+
+    async def synthesize(text, voice, rate=24000):
+        return audio.empty_frame(length=int(sentence_sec * audio.SAMPLE_RATE))
+
+    async def onset():
+        await asyncio.sleep(sentence_sec * 1.4)  # NOTE plus BUFFER_AHEAD_SEC, the second sentence has begun
+
+    adapter = webrtc.WebRTCAdapter(activities.ActivityType.UNSTRUCTURED)
+    adapter.act = mock.Mock(messages=[], voice=None)
+    adapter._WebRTCAdapter__turn = metrics.TurnTimer()
+    adapter.detector.wait_speech_onset = onset
+    track = adapter.responder.audio
+
+    async def sink():
+        while True:
+            await track.recv()
+
+    sinking = asyncio.create_task(sink())
+    with mock.patch.object(webrtc.think, "stream_completion_from_assistant", completion), mock.patch.object(
+        webrtc.utils.speech, "synthesize", synthesize
+    ):
+        await adapter._WebRTCAdapter__respond_interruptibly(adapter._WebRTCAdapter__respond_streaming())
+    sinking.cancel()
+    assert responder.BUFFER_AHEAD_SEC < sentence_sec / 2
+    (msg,), _ = adapter.act.add_msg.call_args
+    assert msg.content == "One. Two."
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lang,expected", [("en", "Hello there. How are you?"), ("cmn", "你好。你好吗？")])
+async def test_speculative_transcripts_joined(short_audio_frame, lang, expected):
+    """Segment transcripts are joined with spaces only in languages that use them."""
+    texts = {"en": ["Hello there.", " How are you? "], "cmn": ["你好。", "你好吗？"]}[lang]
+
+    prompts = []
+
+    async def transcribe(audio_frame, language=None, prompt=None):
+        prompts.append(prompt)
+        return texts[len(prompts) - 1]
+
+    adapter = webrtc.WebRTCAdapter(activities.ActivityType.UNSTRUCTURED)
+    adapter.act = mock.Mock(lang=lang)
+    with mock.patch.object(webrtc.utils.speech, "transcribe", transcribe):
+        adapter._WebRTCAdapter__transcribe_segment(short_audio_frame)
+        adapter._WebRTCAdapter__transcribe_segment(short_audio_frame)
+        assert await adapter._WebRTCAdapter__transcribe_utterance(short_audio_frame) == expected
+    assert prompts == [None, texts[0]]